@@ -1,4 +1,12 @@
 import argparse
+import collections
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import pygame as pg
 import numpy as np
 import cv2
@@ -15,15 +23,118 @@ class AggregationFunction:
         [1.0, 0.0, 1.0],
         [1.0, 1.0, 1.0]
         ])
-
-    def __init__(self, kernel=None):
+    # Stacked grids are passed to filter2D as channels, which OpenCV limits per call
+    MAX_CHANNELS = 128
+    # OpenCV border types of boundary handling, reflect is the filter2D default
+    BOUNDARY_BORDER_TYPES = {'reflect': cv2.BORDER_REFLECT_101, 'wrap': cv2.BORDER_WRAP}
+    METHODS = ('auto', 'direct', 'fft')
+    # filter2D already switches to tiled DFT for large kernels. On 512x512 to 2048x2048 grids it
+    # beat whole grid FFT for every kernel up to 129x129 and neither won consistently up to
+    # 225x225, so auto stays with direct filtering
+    AUTO_METHOD = 'direct'
+
+    def __init__(self, kernel=None, boundary='reflect', method='auto'):
         self.kernel = kernel if kernel is not None else AggregationFunction.CONWAY_KERNEL
+        if boundary not in AggregationFunction.BOUNDARY_BORDER_TYPES:
+            raise ValueError(f'Boundary must be one of {list(AggregationFunction.BOUNDARY_BORDER_TYPES)} however value {boundary} was given.')
+        if method not in AggregationFunction.METHODS:
+            raise ValueError(f'Aggregation method must be one of {AggregationFunction.METHODS} however value {method} was given.')
+        self.boundary = boundary
+        self.method = method
+        self.use_fft = (AggregationFunction.AUTO_METHOD if method == 'auto' else method) == 'fft'
+        self.kernel_spectra = {}
+        self.fft_buffers = {}
+        self.wrap_buffers = {}
     
-    def __call__(self, cell_grid):
-        return cv2.filter2D(src=cell_grid, ddepth=-1, kernel=self.kernel)
+    def __call__(self, cell_grid, out=None):
+        if self.use_fft:
+            return self.fft_aggregate(cell_grid, out)
+        if self.boundary == 'wrap':
+            return self.wrap_aggregate(cell_grid, out)
+        return self.direct_aggregate(cell_grid, out)
+
+    def get_halo(self):
+        # filter2D anchors kernel at its center, so even kernels reach one cell further before than after
+        return tuple((size//2, size - 1 - size//2) for size in self.kernel.shape)
+
+    def direct_aggregate(self, cell_grid, out=None):
+        if cell_grid.ndim == 2 or cell_grid.shape[2] <= AggregationFunction.MAX_CHANNELS:
+            return cv2.filter2D(src=cell_grid, ddepth=-1, kernel=self.kernel, dst=out)
+        agreagation_grid = np.empty_like(cell_grid) if out is None else out
+        for start in range(0, cell_grid.shape[2], AggregationFunction.MAX_CHANNELS):
+            channels = slice(start, start+AggregationFunction.MAX_CHANNELS)
+            agreagation_grid[:, :, channels] = cv2.filter2D(src=np.ascontiguousarray(cell_grid[:, :, channels]),
+                                                            ddepth=-1, kernel=self.kernel)
+        return agreagation_grid
+
+    def wrap_aggregate(self, cell_grid, out=None):
+        # filter2D has no wrap border, so grid is padded by halo into reused buffer and filtered
+        # into another one, only the kept region is copied out
+        (before_x, after_x), (before_y, after_y) = self.get_halo()
+        width, height = cell_grid.shape[:2]
+        agreagation_grid = np.empty_like(cell_grid) if out is None else out
+        channel_count = 1 if cell_grid.ndim == 2 else cell_grid.shape[2]
+        for start in range(0, channel_count, AggregationFunction.MAX_CHANNELS):
+            channels = (slice(None), slice(None)) + (() if cell_grid.ndim == 2 else (slice(start, start+AggregationFunction.MAX_CHANNELS),))
+            source = cell_grid[channels]
+            padded_shape = (width + before_x + after_x, height + before_y + after_y) + source.shape[2:]
+            padded, filtered = self.get_wrap_buffers(padded_shape, cell_grid.dtype)
+            cv2.copyMakeBorder(source, before_x, after_x, before_y, after_y, cv2.BORDER_WRAP, dst=padded)
+            cv2.filter2D(src=padded, ddepth=-1, kernel=self.kernel, dst=filtered)
+            agreagation_grid[channels] = filtered[before_x:before_x+width, before_y:before_y+height]
+        return agreagation_grid
+
+    def get_wrap_buffers(self, padded_shape, dtype):
+        key = (padded_shape, dtype)
+        if key not in self.wrap_buffers:
+            self.wrap_buffers[key] = (np.empty(padded_shape, dtype=dtype), np.empty(padded_shape, dtype=dtype))
+        return self.wrap_buffers[key]
+
+    def fft_aggregate(self, cell_grid, out=None):
+        # Grid is padded by halo and then up to optimal DFT size straight into reused buffer, so
+        # circular convolution never wraps into kept region and nothing is allocated per step
+        (before_x, _), (before_y, _) = self.get_halo()
+        width, height = cell_grid.shape[:2]
+        dtype = np.float32 if cell_grid.dtype == np.float32 else np.float64
+        dft_shape = (cv2.getOptimalDFTSize(width + self.kernel.shape[0] - 1),
+                     cv2.getOptimalDFTSize(height + self.kernel.shape[1] - 1))
+        spectrum = self.get_kernel_spectrum(dft_shape, dtype)
+        grid_buffer, spectrum_buffer = self.get_fft_buffers(dft_shape, dtype)
+        border = (before_x, dft_shape[0] - width - before_x, before_y, dft_shape[1] - height - before_y,
+                  AggregationFunction.BOUNDARY_BORDER_TYPES[self.boundary])
+        agreagation_grid = np.empty_like(cell_grid) if out is None else out
+        channels = [agreagation_grid] if cell_grid.ndim == 2 else [agreagation_grid[:, :, c] for c in range(cell_grid.shape[2])]
+        for channel, target in enumerate(channels):
+            source = cell_grid if cell_grid.ndim == 2 else cell_grid[:, :, channel]
+            cv2.copyMakeBorder(np.ascontiguousarray(source, dtype=dtype), *border, dst=grid_buffer)
+            cv2.dft(grid_buffer, dst=spectrum_buffer, nonzeroRows=width + self.kernel.shape[0] - 1)
+            cv2.mulSpectrums(spectrum_buffer, spectrum, 0, c=spectrum_buffer)
+            cv2.idft(spectrum_buffer, dst=grid_buffer, flags=cv2.DFT_SCALE | cv2.DFT_REAL_OUTPUT)
+            target[...] = grid_buffer[before_x:before_x+width, before_y:before_y+height]
+        return agreagation_grid
+
+    def get_fft_buffers(self, dft_shape, dtype):
+        key = (dft_shape, dtype)
+        if key not in self.fft_buffers:
+            self.fft_buffers[key] = (np.empty(dft_shape, dtype=dtype), np.empty(dft_shape, dtype=dtype))
+        return self.fft_buffers[key]
+
+    def get_kernel_spectrum(self, dft_shape, dtype):
+        key = (dft_shape, dtype)
+        if key not in self.kernel_spectra:
+            # Correlation with kernel is convolution with kernel mirrored around its anchor
+            (anchor_x, _), (anchor_y, _) = self.get_halo()
+            mirrored_x = (anchor_x - np.arange(self.kernel.shape[0])) % dft_shape[0]
+            mirrored_y = (anchor_y - np.arange(self.kernel.shape[1])) % dft_shape[1]
+            kernel_buffer = np.zeros(dft_shape, dtype=dtype)
+            kernel_buffer[np.ix_(mirrored_x, mirrored_y)] = self.kernel
+            self.kernel_spectra[key] = cv2.dft(kernel_buffer)
+        return self.kernel_spectra[key]
 
 class ActivationFunction:
 
+    PARAMETERS = ('median', 'div_squared', 'power', 'scale', 'shift')
+
     def __init__(self, median=2, div_squared=4, power=2, scale=2, shift=-1):
         self.median = median
         self.div_squared = div_squared
@@ -31,27 +142,36 @@ class ActivationFunction:
         self.scale = scale
         self.shift = shift
 
-    def __call__(self, agreagation_grid, dt):
-        exponent = -np.power(agreagation_grid - self.median, self.power) / self.div_squared
-        state_change = self.scale * np.exp(exponent) + self.shift
-        return state_change * dt
-        
+    def __call__(self, agreagation_grid, dt, out=None):
+        # Every stage writes into the same array, out may be the aggregation grid itself
+        state_change = np.subtract(agreagation_grid, self.median, out=out)
+        np.power(state_change, self.power, out=state_change)
+        np.divide(state_change, -self.div_squared, out=state_change)
+        np.exp(state_change, out=state_change)
+        np.multiply(state_change, self.scale, out=state_change)
+        np.add(state_change, self.shift, out=state_change)
+        return np.multiply(state_change, dt, out=state_change)
+
 class UpdateFunction:
 
     def __init__(self):
         pass
 
-    def __call__(self, cell_grid, activation_grid):
-        new_cell_grid = cell_grid + activation_grid
-        return np.maximum(np.minimum(new_cell_grid,1),0)
+    def __call__(self, cell_grid, activation_grid, out=None):
+        new_cell_grid = np.add(cell_grid, activation_grid, out=out)
+        np.minimum(new_cell_grid, 1, out=new_cell_grid)
+        return np.maximum(new_cell_grid, 0, out=new_cell_grid)
 
 class NeuroConway:
 
-    def __init__(self, shape, agregation, activation, update):
+    def __init__(self, shape, agregation, activation, update, dtype=np.float64):
         self.agregation = agregation
         self.activation = activation 
         self.update = update 
-        self.grid = np.zeros(shape)
+        self.grid = np.zeros(shape, dtype=dtype)
+        self.step_count = 0
+        self.recorder = None
+        self.detector = None
 
     def get_grid_height(self):
         return self.grid.shape[1]
@@ -59,14 +179,375 @@ class NeuroConway:
     def get_grid_width(self):
         return self.grid.shape[0]
 
+    def invalidate(self, x=None, y=None):
+        if self.detector is not None:
+            self.detector.reset()
+
+    def attach_detector(self, detector):
+        self.detector = detector
+
+    def get_steady_state(self):
+        return self.detector.event if self.detector is not None else None
+
+    def attach_recorder(self, recorder):
+        self.recorder = recorder
+        self.recorder.record(self.step_count, self.grid)
+
+    def restore(self, history, index=-1):
+        self.grid = np.array(history[index])
+        self.step_count = history.get_step(index)
+        self.invalidate()
+
     def step(self, dt):
         if dt==0:
             return
+        self.advance(dt)
+        self.step_count += 1
+        if self.recorder is not None:
+            self.recorder.record(self.step_count, self.grid)
+        if self.detector is not None:
+            self.detector.observe(self.step_count, self.grid)
+
+    def advance(self, dt):
         agreagation_grid = self.agregation(self.grid)
         activation_grid = self.activation(agreagation_grid, dt)
         self.grid = self.update(self.grid, activation_grid)
 
 
+class BufferedNeuroConway(NeuroConway):
+    '''
+    Steps with preallocated buffers only, aggregation and activation share one buffer and
+    update writes into back grid which is then swapped with front one.
+    '''
+
+    def __init__(self, shape, agregation, activation, update, dtype=np.float64):
+        super().__init__(shape, agregation, activation, update, dtype)
+        self.front_grid = self.grid
+        self.back_grid = np.zeros_like(self.grid)
+        self.agreagation_buffer = np.zeros_like(self.grid)
+
+    def advance(self, dt):
+        if self.grid is not self.front_grid:
+            self.front_grid[...] = self.grid
+            self.grid = self.front_grid
+        agreagation_grid = self.agregation(self.front_grid, out=self.agreagation_buffer)
+        activation_grid = self.activation(agreagation_grid, dt, out=self.agreagation_buffer)
+        self.update(self.front_grid, activation_grid, out=self.back_grid)
+        self.front_grid, self.back_grid = self.back_grid, self.front_grid
+        self.grid = self.front_grid
+
+class ThreadedNeuroConway(BufferedNeuroConway):
+    '''
+    Splits grid into bands of rows stepped on thread pool (cv2 and numpy release GIL).
+    Each band is aggregated together with halo rows taken from its neighbours so
+    result is the same as stepping whole grid at once.
+    '''
+
+    def __init__(self, shape, agregation, activation, update, workers=None, dtype=np.float64):
+        super().__init__(shape, agregation, activation, update, dtype)
+        self.workers = workers if workers is not None else os.cpu_count()
+        if self.workers < 1:
+            raise ValueError(f'Worker count must be 1 or greater however value {self.workers} was given.')
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        (halo_before, halo_after), _ = agregation.get_halo()
+        band_edges = np.linspace(0, shape[0], min(self.workers, shape[0]) + 1).astype(int)
+        self.bands = []
+        for x0, x1 in zip(band_edges[:-1], band_edges[1:]):
+            if agregation.boundary == 'wrap':
+                # Halo rows wrap around, band itself spans whole other axis so aggregation wraps it
+                rows = np.arange(x0-halo_before, x1+halo_after)
+                offset = halo_before
+            else:
+                rows = slice(max(x0-halo_before, 0), min(x1+halo_after, shape[0]))
+                offset = x0 - rows.start
+            region_shape = (len(rows) if agregation.boundary == 'wrap' else rows.stop - rows.start,) + self.grid.shape[1:]
+            region_buffer = np.zeros(region_shape, dtype=dtype) if agregation.boundary == 'wrap' else None
+            self.bands.append((x0, x1, rows, offset, region_buffer, np.zeros(region_shape, dtype=dtype)))
+
+    def advance(self, dt):
+        if self.grid is not self.front_grid:
+            self.front_grid[...] = self.grid
+            self.grid = self.front_grid
+        # Consuming results waits for all bands and re-raises errors from workers
+        list(self.executor.map(lambda band: self.advance_band(band, dt), self.bands))
+        self.front_grid, self.back_grid = self.back_grid, self.front_grid
+        self.grid = self.front_grid
+
+    def advance_band(self, band, dt):
+        x0, x1, rows, offset, region_buffer, agreagation_buffer = band
+        if region_buffer is None:
+            region = self.front_grid[rows]
+        else:
+            region = np.take(self.front_grid, rows, axis=0, out=region_buffer, mode='wrap')
+        agreagation_grid = self.agregation(region, out=agreagation_buffer)[offset:offset+x1-x0]
+        activation_grid = self.activation(agreagation_grid, dt, out=agreagation_grid)
+        self.update(self.front_grid[x0:x1], activation_grid, out=self.back_grid[x0:x1])
+
+    def close(self):
+        self.executor.shutdown()
+
+
+def dilate_tile_mask(mask):
+    padded = np.pad(mask, 1)
+    dilated = np.zeros_like(mask)
+    for dx in range(3):
+        for dy in range(3):
+            dilated |= padded[dx:dx+mask.shape[0], dy:dy+mask.shape[1]]
+    return dilated
+
+class SparseNeuroConway(NeuroConway):
+    '''
+    Steps only tiles that changed in previous step (and their neighbours). Cell whose whole
+    neighbourhood did not change would get the same update as before, which was zero, so
+    skipping it gives the same grid as dense stepping as long as dt stays the same.
+    Any change of grid from outside of step must be reported with invalidate.
+    '''
+
+    DEFAULT_TILE_SIZE = 64
+
+    def __init__(self, shape, agregation, activation, update, tile_size=DEFAULT_TILE_SIZE, dtype=np.float64):
+        super().__init__(shape, agregation, activation, update, dtype)
+        if agregation.boundary != 'reflect':
+            raise ValueError(f'Sparse stepping supports only reflect boundary however {agregation.boundary} was given.')
+        self.halo = max(agregation.kernel.shape)//2
+        if tile_size < max(self.halo, 1):
+            raise ValueError(f'Tile size must be at least {max(self.halo, 1)} for given kernel however value {tile_size} was given.')
+        self.tile_size = tile_size
+        self.tile_shape = (-(-shape[0]//tile_size), -(-shape[1]//tile_size))
+        self.back_grid = np.zeros_like(self.grid)
+        self.active_tiles = np.ones(self.tile_shape, dtype=bool)
+        self.stepped_grid = self.grid
+        self.last_dt = None
+
+    def invalidate(self, x=None, y=None):
+        super().invalidate(x, y)
+        if x is None or y is None:
+            self.active_tiles[:] = True
+            return
+        tile_x = x//self.tile_size
+        tile_y = y//self.tile_size
+        self.active_tiles[max(tile_x-1, 0):tile_x+2, max(tile_y-1, 0):tile_y+2] = True
+
+    def get_active_fraction(self):
+        return np.count_nonzero(self.active_tiles) / self.active_tiles.size
+
+    def advance(self, dt):
+        if self.grid is not self.stepped_grid or dt != self.last_dt:
+            # Grid was replaced or dt changed, previous step says nothing about the next one
+            if self.back_grid.shape != self.grid.shape:
+                raise ValueError(f'Grid shape cannot change from {self.back_grid.shape} to {self.grid.shape} in sparse mode.')
+            self.active_tiles[:] = True
+        width, height = self.grid.shape
+        changed_tiles = np.zeros(self.tile_shape, dtype=bool)
+        for tile_x, tile_y in zip(*np.nonzero(self.active_tiles)):
+            x0 = tile_x*self.tile_size
+            x1 = min(x0+self.tile_size, width)
+            y0 = tile_y*self.tile_size
+            y1 = min(y0+self.tile_size, height)
+            halo_x0 = max(x0-self.halo, 0)
+            halo_y0 = max(y0-self.halo, 0)
+            region = self.grid[halo_x0:min(x1+self.halo, width), halo_y0:min(y1+self.halo, height)]
+            agreagation_tile = self.agregation(region)[x0-halo_x0:x1-halo_x0, y0-halo_y0:y1-halo_y0]
+            tile = self.grid[x0:x1, y0:y1]
+            new_tile = self.update(tile, self.activation(agreagation_tile, dt), out=self.back_grid[x0:x1, y0:y1])
+            changed_tiles[tile_x, tile_y] = not np.array_equal(new_tile, tile)
+        # Inactive tiles did not change last step so both buffers already hold same values there
+        self.grid, self.back_grid = self.back_grid, self.grid
+        self.stepped_grid = self.grid
+        self.last_dt = dt
+        self.active_tiles = dilate_tile_mask(changed_tiles)
+
+class EnsembleNeuroConway(NeuroConway):
+    '''
+    Many grids with separate activation parameters stacked along last axis, so that whole
+    ensemble is aggregated and activated with the same calls as a single grid.
+    '''
+
+    def __init__(self, shape, agregation, activations, update, dtype=np.float64):
+        self.member_activations = activations
+        # Parameters share dtype of grid, otherwise float32 ensemble would be promoted to float64
+        stacked_parameters = [np.array([getattr(activation, name) for activation in activations], dtype=dtype)
+                              for name in ActivationFunction.PARAMETERS]
+        super().__init__((shape[0], shape[1], len(activations)), agregation,
+                         ActivationFunction(*stacked_parameters), update, dtype)
+
+    def get_member_count(self):
+        return self.grid.shape[2]
+
+    def get_member_grid(self, index):
+        return self.grid[:, :, index]
+
+    def set_all_members(self, grid):
+        self.grid[...] = grid[:, :, np.newaxis]
+
+    def member_summaries(self):
+        means = self.grid.mean(axis=(0, 1))
+        active_fractions = np.count_nonzero(self.grid > 0.5, axis=(0, 1)) / (self.grid.shape[0]*self.grid.shape[1])
+        return [dict({name: getattr(activation, name) for name in ActivationFunction.PARAMETERS},
+                     mean=float(mean), active_fraction=float(active_fraction))
+                for activation, mean, active_fraction in zip(self.member_activations, means, active_fractions)]
+
+
+#==================================================================================================
+#                                       GRID HISTORY
+#==================================================================================================
+
+class GridRecorder:
+    '''
+    Streams every n-th grid to chunk files on disk from a background thread. Each chunk is a
+    memory mapped .npy file so neither recorder nor reader has to keep whole history in memory.
+    '''
+
+    METADATA_FILE = 'history.json'
+    CHUNK_FILE = 'chunk_{:06d}.npy'
+    DEFAULT_CHUNK_SIZE = 256
+    DEFAULT_QUEUE_SIZE = 16
+
+    def __init__(self, path, every=1, chunk_size=DEFAULT_CHUNK_SIZE, queue_size=DEFAULT_QUEUE_SIZE):
+        if every < 1:
+            raise ValueError(f'Recording interval must be 1 or greater however value {every} was given.')
+        if chunk_size < 1:
+            raise ValueError(f'Chunk size must be 1 or greater however value {chunk_size} was given.')
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.every = every
+        self.chunk_size = chunk_size
+        self.steps = []
+        self.shape = None
+        self.dtype = None
+        self.chunk = None
+        self.error = None
+        self.frames = queue.Queue(maxsize=queue_size)
+        self.writer = threading.Thread(target=self.write_frames, daemon=True)
+        self.writer.start()
+
+    def record(self, step_index, grid):
+        if self.error is not None:
+            raise self.error
+        if step_index % self.every == 0:
+            self.frames.put((step_index, grid.copy()))
+
+    def close(self):
+        if self.writer.is_alive():
+            self.frames.put(None)
+        self.writer.join()
+        if self.error is not None:
+            raise self.error
+
+    def write_frames(self):
+        frame = ()
+        try:
+            while True:
+                frame = self.frames.get()
+                if frame is None:
+                    break
+                self.write_frame(*frame)
+            self.chunk = None
+            self.write_metadata()
+        except Exception as e:
+            self.error = e
+            # Queue is drained until close, otherwise record and close would block on full queue forever
+            while frame is not None:
+                frame = self.frames.get()
+
+    def write_frame(self, step_index, grid):
+        if self.shape is None:
+            self.shape = grid.shape
+            self.dtype = grid.dtype
+        elif grid.shape != self.shape:
+            raise ValueError(f'Recorded grid shape changed from {self.shape} to {grid.shape}.')
+        chunk_index, offset = divmod(len(self.steps), self.chunk_size)
+        if offset == 0:
+            chunk_path = os.path.join(self.path, GridRecorder.CHUNK_FILE.format(chunk_index))
+            self.chunk = np.lib.format.open_memmap(chunk_path, mode='w+', dtype=self.dtype,
+                                                   shape=(self.chunk_size,) + self.shape)
+        self.chunk[offset] = grid
+        self.steps.append(step_index)
+        if offset == self.chunk_size - 1:
+            self.chunk.flush()
+            self.chunk = None
+            self.write_metadata()
+
+    def write_metadata(self):
+        metadata = {
+            'frame_count': len(self.steps),
+            'chunk_size': self.chunk_size,
+            'shape': list(self.shape) if self.shape is not None else None,
+            'dtype': str(self.dtype),
+            'every': self.every,
+            'steps': self.steps
+        }
+        with open(os.path.join(self.path, GridRecorder.METADATA_FILE), 'w') as metadata_file:
+            json.dump(metadata, metadata_file)
+
+
+class GridHistory:
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, GridRecorder.METADATA_FILE)) as metadata_file:
+            metadata = json.load(metadata_file)
+        self.frame_count = metadata['frame_count']
+        self.chunk_size = metadata['chunk_size']
+        self.steps = metadata['steps']
+        self.chunks = {}
+
+    def __len__(self):
+        return self.frame_count
+
+    def frame_index(self, index):
+        if index < 0:
+            index += self.frame_count
+        if not 0 <= index < self.frame_count:
+            raise IndexError(f'Frame {index} is outside of recorded history with {self.frame_count} frames.')
+        return index
+
+    def __getitem__(self, index):
+        chunk_index, offset = divmod(self.frame_index(index), self.chunk_size)
+        if chunk_index not in self.chunks:
+            chunk_path = os.path.join(self.path, GridRecorder.CHUNK_FILE.format(chunk_index))
+            self.chunks[chunk_index] = np.load(chunk_path, mmap_mode='r')
+        return self.chunks[chunk_index][offset]
+
+    def get_step(self, index):
+        return self.steps[self.frame_index(index)]
+
+
+class SteadyStateDetector:
+    '''
+    Keeps hashes of last grids quantized to given step, so that states differing only by
+    float noise are treated as equal, and finds first fixed point or cycle up to max period.
+    '''
+
+    DEFAULT_MAX_PERIOD = 16
+    DEFAULT_QUANTUM = 1e-6
+
+    def __init__(self, max_period=DEFAULT_MAX_PERIOD, quantum=DEFAULT_QUANTUM):
+        if max_period < 1:
+            raise ValueError(f'Maximum period must be 1 or greater however value {max_period} was given.')
+        if quantum <= 0:
+            raise ValueError(f'Quantization step must be larger than 0 however value {quantum} was given.')
+        self.max_period = max_period
+        self.quantum = quantum
+        self.recent_hashes = collections.deque(maxlen=max_period)
+        self.event = None
+
+    def reset(self):
+        self.recent_hashes.clear()
+        self.event = None
+
+    def observe(self, step_index, grid):
+        quantized = np.rint(grid / self.quantum).astype(np.int64)
+        grid_hash = hashlib.blake2b(quantized.tobytes(), digest_size=16).digest()
+        if self.event is None:
+            for period, previous_hash in enumerate(reversed(self.recent_hashes), start=1):
+                if previous_hash == grid_hash:
+                    self.event = {'step': step_index, 'period': period, 'fixed_point': period == 1}
+                    break
+        self.recent_hashes.append(grid_hash)
+        return self.event
+
+
 #==================================================================================================
 #                                   PYGAME INTERFACE 
 #==================================================================================================
@@ -79,23 +560,29 @@ class Display:
 
     def __init__(self, window_size, grid_size):
         self.window_size = window_size
+        self.grid_size = grid_size
         self.cell_size = (window_size[0]//grid_size[0], window_size[1]//grid_size[1])
+        self.scaled_size = (grid_size[0]*self.cell_size[0], grid_size[1]*self.cell_size[1])
         self.screen = None
+        self.grid_surface = None
+        self.brightness = np.empty(grid_size, dtype=np.float32)
+        self.pixels = np.empty((grid_size[0], grid_size[1], 3), dtype=np.uint8)
 
     def init(self):
         self.screen = pg.display.set_mode(self.window_size)
+        self.grid_surface = pg.Surface(self.grid_size)
 
     def draw_grid_cell(self, cell_grid):
-        for x in range(cell_grid.get_grid_width()):
-            for y in range(cell_grid.get_grid_height()):
-                cell_brightness = Display.BACKGROUND_BRIGHTNESS+cell_grid.grid[x][y]*Display.BRIGHTNESS_RANGE
-                cell_brightness = (cell_brightness, cell_brightness, cell_brightness)
-                try:
-                    pg.draw.rect(self.screen,
-                                 cell_brightness,
-                                (x*self.cell_size[0], y*self.cell_size[1], self.cell_size[0], self.cell_size[1]))
-                except ValueError:
-                    print(f'Problematic color {cell_brightness}')
+        self.draw_grid(cell_grid.grid)
+
+    def draw_grid(self, grid):
+        # Grid is indexed [x][y] same as surfarray so it can be written to surface without transposing
+        np.multiply(grid, Display.BRIGHTNESS_RANGE, out=self.brightness, casting='unsafe')
+        np.add(self.brightness, Display.BACKGROUND_BRIGHTNESS, out=self.brightness)
+        np.clip(self.brightness, 0, Display.MAX_BRIGHTNESS, out=self.brightness)
+        self.pixels[...] = self.brightness[:, :, np.newaxis]
+        pg.surfarray.blit_array(self.grid_surface, self.pixels)
+        self.screen.blit(pg.transform.scale(self.grid_surface, self.scaled_size), (0, 0))
 
     def flip(self):
         pg.display.flip() 
@@ -105,9 +592,12 @@ class SimulationState:
 
     MILLISECOND_TO_SECOND_RATIO = 1000
 
-    def __init__(self):
+    def __init__(self, max_fps=0):
         self.running = False
         self.paused = False
+        # Set by grid edits so that threaded worker publishes grid even when it makes no step
+        self.grid_edited = False
+        self.max_fps = max_fps
         self.clock = pg.time.Clock()
     
     def init(self):
@@ -115,8 +605,10 @@ class SimulationState:
         self.clock.tick()
 
     def tick(self):
+        # Clock waits here when frame rate is capped
+        frame_time = self.clock.tick(self.max_fps)/SimulationState.MILLISECOND_TO_SECOND_RATIO
         if not self.paused:
-            return self.clock.tick()/SimulationState.MILLISECOND_TO_SECOND_RATIO
+            return frame_time
         return 0
 
     def toggle_pause(self):
@@ -141,10 +633,11 @@ class KeyboardHandler:
 
 class MouseHandler:
 
-    def __init__(self, simulation_state, display, cell_grid):
+    def __init__(self, simulation_state, display, cell_grid, grid_lock):
         self.simulation_state = simulation_state
         self.display = display
         self.cell_grid = cell_grid
+        self.grid_lock = grid_lock
 
     def handle_event(self, event):
         mouse_presses = pg.mouse.get_pressed()
@@ -152,16 +645,99 @@ class MouseHandler:
             x, y = pg.mouse.get_pos()
             x = x//self.display.cell_size[0]
             y = y//self.display.cell_size[1]
-            self.cell_grid.grid[x][y] = 1 - self.cell_grid.grid[x][y] 
+            with self.grid_lock:
+                self.cell_grid.grid[x][y] = 1 - self.cell_grid.grid[x][y] 
+                self.cell_grid.invalidate(x, y)
+                self.simulation_state.grid_edited = True
+
+class FixedStepAccumulator:
+    '''
+    Turns elapsed wall clock time into a number of fixed physics steps. When simulation
+    cannot keep up, at most max_catch_up steps are made and rest of the backlog is dropped.
+    '''
+
+    def __init__(self, physics_dt, max_catch_up):
+        if physics_dt <= 0:
+            raise ValueError(f'Physics timestep must be larger than 0 however value {physics_dt} was given.')
+        if max_catch_up < 1:
+            raise ValueError(f'Catch up budget must be 1 or greater however value {max_catch_up} was given.')
+        self.physics_dt = physics_dt
+        self.max_catch_up = max_catch_up
+        self.accumulator = 0.0
+
+    def due_steps(self, elapsed):
+        self.accumulator += elapsed
+        steps = min(int(self.accumulator // self.physics_dt), self.max_catch_up)
+        self.accumulator -= steps * self.physics_dt
+        if steps == self.max_catch_up:
+            self.accumulator = min(self.accumulator, self.physics_dt)
+        return steps
+
+class SimulationWorker:
+    '''
+    Steps grid on its own thread and publishes copies of it through two display buffers,
+    so rendering never sees half updated grid and never waits for a whole step.
+    '''
+
+    def __init__(self, cell_grid, simulation_state, grid_lock, accumulator):
+        self.cell_grid = cell_grid
+        self.simulation_state = simulation_state
+        self.grid_lock = grid_lock
+        self.accumulator = accumulator
+        self.front_buffer = cell_grid.grid.copy()
+        self.back_buffer = cell_grid.grid.copy()
+        self.buffer_lock = threading.Lock()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def join(self):
+        self.thread.join()
+
+    def loop(self):
+        last_time = time.perf_counter()
+        while self.simulation_state.running:
+            now = time.perf_counter()
+            elapsed = 0.0 if self.simulation_state.paused else now - last_time
+            last_time = now
+            steps = self.accumulator.due_steps(elapsed)
+            if steps == 0 and not self.simulation_state.grid_edited:
+                time.sleep(max(self.accumulator.physics_dt - self.accumulator.accumulator, 0.0))
+                continue
+            with self.grid_lock:
+                for _ in range(steps):
+                    self.cell_grid.step(self.accumulator.physics_dt)
+                self.simulation_state.grid_edited = False
+                np.copyto(self.back_buffer, self.cell_grid.grid)
+            with self.buffer_lock:
+                self.front_buffer, self.back_buffer = self.back_buffer, self.front_buffer
+
+    def draw(self, display):
+        with self.buffer_lock:
+            display.draw_grid(self.front_buffer)
 
 class SimulationEngine:
 
-    def __init__(self, cell_grid, display):
+    DEFAULT_MAX_CATCH_UP = 5
+    # Uncapped render loop would only redraw the same buffer and take GIL from the worker
+    DEFAULT_THREADED_MAX_FPS = 60
+
+    def __init__(self, cell_grid, display, physics_dt=None, max_fps=None, max_catch_up=DEFAULT_MAX_CATCH_UP,
+                 threaded=False):
+        if threaded and physics_dt is None:
+            raise ValueError('Stepping grid on separate thread requires fixed physics timestep.')
+        if max_fps is None:
+            max_fps = SimulationEngine.DEFAULT_THREADED_MAX_FPS if threaded else 0
         self.cell_grid=cell_grid 
         self.display = display
-        self.state = SimulationState()
+        self.state = SimulationState(max_fps)
+        self.grid_lock = threading.Lock()
+        self.accumulator = FixedStepAccumulator(physics_dt, max_catch_up) if physics_dt is not None else None
+        self.worker = SimulationWorker(cell_grid, self.state, self.grid_lock, self.accumulator) if threaded else None
+        self.steady_state = None
         self.keyboard = KeyboardHandler(self.state, self)
-        self.mouse = MouseHandler(self.state, self.display, self.cell_grid)
+        self.mouse = MouseHandler(self.state, self.display, self.cell_grid, self.grid_lock)
 
     def init(self):
         pg.init()
@@ -183,13 +759,107 @@ class SimulationEngine:
             elif event.type == pg.MOUSEBUTTONDOWN:
                 self.mouse.handle_event(event)
 
+    def report_steady_state(self):
+        if self.cell_grid.get_steady_state() != self.steady_state:
+            self.steady_state = self.cell_grid.get_steady_state()
+            if self.steady_state is not None:
+                print(f'Steady state with period {self.steady_state["period"]} reached at step {self.steady_state["step"]}')
+
     def run(self):
+        if self.worker is not None:
+            self.run_threaded()
+            return
         while self.state.running:
             self.display.draw_grid_cell(self.cell_grid)
             self.display.flip()
             self.handle_events()
             dt = self.state.tick()
-            self.cell_grid.step(dt)
+            if self.accumulator is None:
+                self.cell_grid.step(dt)
+            else:
+                for _ in range(self.accumulator.due_steps(dt)):
+                    self.cell_grid.step(self.accumulator.physics_dt)
+            self.report_steady_state()
+
+    def run_threaded(self):
+        self.worker.start()
+        try:
+            while self.state.running:
+                self.worker.draw(self.display)
+                self.display.flip()
+                self.handle_events()
+                self.state.tick()
+                self.report_steady_state()
+        finally:
+            self.state.running = False
+            self.worker.join()
+
+
+#==================================================================================================
+#                                   HEADLESS INTERFACE 
+#==================================================================================================
+
+class HeadlessRunner:
+
+    def __init__(self, cell_grid, dt, steps=None, time_budget=None, report_interval=None, stop_on_steady=False):
+        if dt <= 0:
+            raise ValueError(f'Timestep must be larger than 0 however value {dt} was given.')
+        if steps is None and time_budget is None:
+            raise ValueError('Headless run needs a step count, a time budget or both.')
+        self.cell_grid = cell_grid
+        self.dt = dt
+        self.steps = steps
+        self.time_budget = time_budget
+        self.report_interval = report_interval
+        self.stop_on_steady = stop_on_steady
+        self.steps_done = 0
+        self.elapsed = 0.0
+
+    def finished(self):
+        if self.steps is not None and self.steps_done >= self.steps:
+            return True
+        if self.time_budget is not None and self.elapsed >= self.time_budget:
+            return True
+        if self.stop_on_steady and self.cell_grid.get_steady_state() is not None:
+            return True
+        return False
+
+    def run(self):
+        start = time.perf_counter()
+        while not self.finished():
+            self.cell_grid.step(self.dt)
+            self.steps_done += 1
+            self.elapsed = time.perf_counter() - start
+            if self.report_interval and self.steps_done % self.report_interval == 0:
+                self.report()
+        return self.summary()
+
+    def steps_per_second(self):
+        return self.steps_done / self.elapsed if self.elapsed > 0 else 0.0
+
+    def cells_per_second(self):
+        return self.steps_per_second() * self.cell_grid.grid.size
+
+    def report(self):
+        print(f'step {self.steps_done}: {self.steps_per_second():.1f} steps/s, '
+              f'{self.cells_per_second():.3e} cells/s')
+
+    def summary(self):
+        grid = self.cell_grid.grid
+        return {
+            'steps': self.steps_done,
+            'simulated_time': self.steps_done * self.dt,
+            'elapsed': self.elapsed,
+            'steps_per_second': self.steps_per_second(),
+            'cells_per_second': self.cells_per_second(),
+            'grid_shape': list(grid.shape),
+            'mean': float(grid.mean()),
+            'std': float(grid.std()),
+            'min': float(grid.min()),
+            'max': float(grid.max()),
+            'active_fraction': float(np.count_nonzero(grid > 0.5) / grid.size),
+            'steady_state': self.cell_grid.get_steady_state()
+        }
 
 
 #==================================================================================================
@@ -215,20 +885,133 @@ def parse_arguments():
                         help='Size of cellular grid')
     parser.add_argument('--window_shape', type=size2D, default=(800, 800),
                         help='Size of program main window in pixels')
-    return parser.parse_args()
+    parser.add_argument('--kernel_file', type=str, default=None,
+                        help='File with aggregation kernel saved as .npy, Conway neighbourhood is used by default')
+    parser.add_argument('--boundary', choices=list(AggregationFunction.BOUNDARY_BORDER_TYPES), default='reflect',
+                        help='How grid edges are handled, wrap makes grid a torus')
+    parser.add_argument('--aggregation_method', choices=AggregationFunction.METHODS, default='auto',
+                        help='Use direct filtering or FFT, auto picks direct filtering which measured faster')
+    parser.add_argument('--dtype', choices=['float32', 'float64'], default='float64',
+                        help='Precision of cell grid')
+    parser.add_argument('--in_place', action='store_true',
+                        help='Step using preallocated buffers only')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Steps grid in bands on given number of threads, 0 uses all cores')
+    parser.add_argument('--tile_size', type=int, default=None,
+                        help='Enables sparse stepping that only updates changed tiles of given size')
+    parser.add_argument('--ensemble', type=str, default=None,
+                        help='JSON file with list of activation parameter sets stepped together in headless mode')
+    parser.add_argument('--physics_dt', type=float, default=None,
+                        help='Fixed timestep of windowed simulation, by default frame time is used')
+    parser.add_argument('--max_fps', type=int, default=None,
+                        help='Frame rate cap of window, 0 means no cap, by default uncapped or 60 with --threaded')
+    parser.add_argument('--max_catch_up', type=int, default=SimulationEngine.DEFAULT_MAX_CATCH_UP,
+                        help='Maximum number of fixed steps made per frame to catch up with wall clock')
+    parser.add_argument('--threaded', action='store_true',
+                        help='Steps simulation on separate thread, requires --physics_dt')
+    parser.add_argument('--random_fill', type=float, default=0.0,
+                        help='Fraction of cells that are set to one at start')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Seed for random grid fill')
+    parser.add_argument('--record_dir', type=str, default=None,
+                        help='Directory to which grid history is streamed')
+    parser.add_argument('--record_every', type=int, default=1,
+                        help='Record every given number of steps')
+    parser.add_argument('--restore_dir', type=str, default=None,
+                        help='Directory with recorded grid history from which starting grid is taken')
+    parser.add_argument('--restore_frame', type=int, default=-1,
+                        help='Index of recorded frame used as starting grid')
+    parser.add_argument('--detect_period', type=int, default=None,
+                        help='Detects fixed points and cycles up to given period')
+    parser.add_argument('--quantum', type=float, default=SteadyStateDetector.DEFAULT_QUANTUM,
+                        help='Quantization step used when comparing grids during steady state detection')
+    parser.add_argument('--stop_on_steady', action='store_true',
+                        help='Stops headless run once steady state is detected')
+    parser.add_argument('--headless', action='store_true',
+                        help='Run simulation without window using fixed timestep')
+    parser.add_argument('--dt', type=float, default=0.05,
+                        help='Fixed timestep used in headless mode')
+    parser.add_argument('--steps', type=int, default=None,
+                        help='Number of steps performed in headless mode')
+    parser.add_argument('--time_budget', type=float, default=None,
+                        help='Wall clock time in seconds after which headless run stops')
+    parser.add_argument('--report_interval', type=int, default=None,
+                        help='Print throughput every given number of headless steps')
+    parser.add_argument('--stats_file', type=str, default=None,
+                        help='JSON file to which headless run summary is written')
+    args = parser.parse_args()
+    if args.ensemble is not None and (not args.headless or args.tile_size is not None or args.in_place):
+        parser.error('--ensemble can only be used in headless mode without --tile_size and --in_place')
+    if args.threaded and args.physics_dt is None:
+        parser.error('--threaded requires --physics_dt')
+    if args.tile_size is not None and (args.in_place or args.workers is not None):
+        parser.error('--tile_size cannot be used together with --in_place or --workers')
+    if args.ensemble is not None and args.workers is not None:
+        parser.error('--ensemble cannot be used together with --workers')
+    return args
+
+def run_headless(conway, args):
+    runner = HeadlessRunner(conway, args.dt, args.steps, args.time_budget, args.report_interval,
+                            args.stop_on_steady)
+    summary = runner.run()
+    if isinstance(conway, EnsembleNeuroConway):
+        summary['members'] = conway.member_summaries()
+    print(f'{summary["steps"]} steps in {summary["elapsed"]:.2f}s -> '
+          f'{summary["steps_per_second"]:.1f} steps/s, {summary["cells_per_second"]:.3e} cells/s')
+    if args.stats_file is not None:
+        with open(args.stats_file, 'w') as stats_file:
+            json.dump(summary, stats_file, indent=2)
 
 #median=2, div_squared=4, power=2, scale=2, shift=-1):
 def main(args):
-    agregation = AggregationFunction()
+    kernel = np.load(args.kernel_file) if args.kernel_file is not None else None
+    agregation = AggregationFunction(kernel, args.boundary, args.aggregation_method)
     activation = ActivationFunction(args.median, args.divergence_squared, args.power,
                                     args.scale, args.shift)
     update = UpdateFunction()
-    conway = NeuroConway(args.grid_shape, agregation, activation, update)
-    display = Display(args.window_shape, args.grid_shape)
-    game = SimulationEngine(conway, display)
-    game.init()
-    #game.plot_activations()
-    game.run()
+    dtype = np.dtype(args.dtype)
+    if args.ensemble is not None:
+        with open(args.ensemble) as ensemble_file:
+            parameter_sets = json.load(ensemble_file)
+        activations = [ActivationFunction(**dict(vars(activation), **parameters)) for parameters in parameter_sets]
+        conway = EnsembleNeuroConway(args.grid_shape, agregation, activations, update, dtype)
+    elif args.tile_size is not None:
+        conway = SparseNeuroConway(args.grid_shape, agregation, activation, update, args.tile_size, dtype)
+    elif args.workers is not None:
+        conway = ThreadedNeuroConway(args.grid_shape, agregation, activation, update, args.workers or None, dtype)
+    elif args.in_place:
+        conway = BufferedNeuroConway(args.grid_shape, agregation, activation, update, dtype)
+    else:
+        conway = NeuroConway(args.grid_shape, agregation, activation, update, dtype)
+    if args.random_fill > 0:
+        rng = np.random.default_rng(args.seed)
+        initial_grid = (rng.random(args.grid_shape) < args.random_fill).astype(dtype)
+        if isinstance(conway, EnsembleNeuroConway):
+            conway.set_all_members(initial_grid)
+        else:
+            conway.grid = initial_grid
+    if args.restore_dir is not None:
+        conway.restore(GridHistory(args.restore_dir), args.restore_frame)
+    if args.detect_period is not None:
+        conway.attach_detector(SteadyStateDetector(args.detect_period, args.quantum))
+    elif args.stop_on_steady:
+        conway.attach_detector(SteadyStateDetector(quantum=args.quantum))
+    if args.record_dir is not None:
+        conway.attach_recorder(GridRecorder(args.record_dir, args.record_every))
+    try:
+        if args.headless:
+            run_headless(conway, args)
+            return
+        display = Display(args.window_shape, args.grid_shape)
+        game = SimulationEngine(conway, display, args.physics_dt, args.max_fps, args.max_catch_up, args.threaded)
+        game.init()
+        #game.plot_activations()
+        game.run()
+    finally:
+        if isinstance(conway, ThreadedNeuroConway):
+            conway.close()
+        if conway.recorder is not None:
+            conway.recorder.close()
 
 if __name__ == '__main__':
     args = parse_arguments()
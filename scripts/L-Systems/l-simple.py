@@ -3,7 +3,14 @@ import math
 import argparse
 import xml.etree.ElementTree as ET
 import os
+import json
+import time
+import hashlib
 import logging 
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from collections import namedtuple, Counter
+from itertools import islice
 
 #---------------------------------------------------------------------------------------------------
 #                                           GLOBALS 
@@ -42,12 +49,53 @@ class LSystem:
 
     def __init__(self, rules, axiom):
         self.rules = rules
+        self.axiom = axiom
         self.sequence = axiom
 
     def step(self):
         # If there is no rule use identity rule
         self.sequence = ''.join(self.rules.get(element, element) for element in self.sequence)
 
+    def expand(self, generations, descend=None):
+        # Yields (symbol, depth) of given generation depth first without building the sequence,
+        # only one position in a rule per generation is remembered. Final symbols have depth 0,
+        # symbol which descend(symbol, depth) refused to rewrite keeps its remaining depth
+        stack = [(iter(self.axiom), generations)]
+        while stack:
+            symbols, depth = stack[-1]
+            symbol = next(symbols, None)
+            if symbol is None:
+                stack.pop()
+            elif depth == 0 or symbol not in self.rules:
+                yield symbol, 0
+            elif descend is not None and not descend(symbol, depth):
+                yield symbol, depth
+            else:
+                stack.append((iter(self.rules[symbol]), depth - 1))
+
+    def symbol_count(self, generations):
+        # Length of given generation from counts of every symbol, nothing is expanded
+        counts = Counter(self.axiom)
+        for _ in range(generations):
+            expanded = Counter()
+            for symbol, count in counts.items():
+                for target in self.rules.get(symbol, symbol):
+                    expanded[target] += count
+            counts = expanded
+        return sum(counts.values())
+
+    def encode(self, generations):
+        # Whole generation as array of ASCII codes, each generation is one gather from table of
+        # concatenated rule bodies
+        bodies = [self.rules.get(chr(code), chr(code)).encode('ascii') for code in range(128)]
+        lengths = np.array([len(body) for body in bodies], dtype=np.int64)
+        starts = np.cumsum(lengths) - lengths
+        table = np.frombuffer(b''.join(bodies), dtype=np.uint8)
+        codes = np.frombuffer(self.axiom.encode('ascii'), dtype=np.uint8)
+        for _ in range(generations):
+            codes = table[expand_ranges(starts[codes], lengths[codes])]
+        return codes
+
 
 def lsystem_rule_string(txt):
     entires = txt.split(';')
@@ -57,37 +105,313 @@ def lsystem_rule_string(txt):
         rules[base] = target
     return rules
 
-def draw_tree(window, axiom, initial_length, angle, starting_point, angle_step):
-    stack = []
-    position = starting_point
-    length = initial_length
-
-    axiom = ''.join(axiom)
-    for char in axiom:
-        if char == 'F':
-            new_x = position[0] + length * math.cos(math.radians(angle))
-            new_y = position[1] - length * math.sin(math.radians(angle))
-            pygame.draw.line(window, BLACK, position, (new_x, new_y), 2)
-            position = (new_x, new_y)
-        elif char == 'f':
-            new_x = position[0] + length * math.cos(math.radians(angle))
-            new_y = position[1] - length * math.sin(math.radians(angle))
-            position = (new_x, new_y)
-        elif char == '+':
-            angle -= angle_step 
-        elif char == '-':
-            angle += angle_step
-        elif char == '[':
-            stack.append((position, angle))
-        elif char == ']':
-            position, angle = stack.pop()
-
-    pygame.display.update()
+GeometrySummary = namedtuple('GeometrySummary', ['displacement', 'turn', 'hull', 'segment_count'])
+
+def convex_hull(points):
+    # Monotone chain, returns hull corners in counter clockwise order
+    points = sorted(set(points))
+    if len(points) <= 2:
+        return points
+
+    def half_hull(ordered):
+        hull = []
+        for point in ordered:
+            while len(hull) >= 2 and ((hull[-1][0] - hull[-2][0]) * (point[1] - hull[-2][1]) -
+                                      (hull[-1][1] - hull[-2][1]) * (point[0] - hull[-2][0])) <= 0:
+                hull.pop()
+            hull.append(point)
+        return hull
+
+    lower = half_hull(points)
+    upper = half_hull(reversed(points))
+    return lower[:-1] + upper[:-1]
+
+def rotate(point, angle):
+    # Rotation of turtle heading by angle in screen coordinates where y axis points down
+    cos_angle = math.cos(math.radians(angle))
+    sin_angle = math.sin(math.radians(angle))
+    return (cos_angle * point[0] + sin_angle * point[1], cos_angle * point[1] - sin_angle * point[0])
+
+def bounding_box(points):
+    if not points:
+        return None
+    xs = [point[0] for point in points]
+    ys = [point[1] for point in points]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+class LSystemGeometry:
+    # Summaries of what the turtle does while drawing a symbol expanded for given number of
+    # generations. They are expressed in frame of turtle starting at origin with angle 0, so one
+    # summary serves every place where the subtree appears. Convex hull is kept instead of
+    # bounding box because it stays exact when subtree is rotated.
+
+    def __init__(self, l_system, length, angle_step):
+        self.l_system = l_system
+        self.length = length
+        self.angle_step = angle_step
+        self.cache = {}
+
+    def summary(self, symbol, depth):
+        key = (symbol, depth)
+        if key not in self.cache:
+            if depth > 0 and symbol in self.l_system.rules:
+                self.cache[key] = self.compose(self.l_system.rules[symbol], depth - 1)
+            else:
+                self.cache[key] = self.compose_terminal(symbol)
+        return self.cache[key]
+
+    def compose_terminal(self, symbol):
+        if symbol == 'F':
+            return GeometrySummary((self.length, 0.0), 0.0, [(0.0, 0.0), (self.length, 0.0)], 1)
+        if symbol == 'f':
+            return GeometrySummary((self.length, 0.0), 0.0, [], 0)
+        if symbol == '+':
+            return GeometrySummary((0.0, 0.0), -self.angle_step, [], 0)
+        if symbol == '-':
+            return GeometrySummary((0.0, 0.0), self.angle_step, [], 0)
+        if symbol in '[]':
+            raise ValueError(f'Brackets must be balanced within every rule, unmatched {symbol} was found.')
+        return GeometrySummary((0.0, 0.0), 0.0, [], 0)
+
+    def compose(self, symbols, depth):
+        stack = []
+        position = (0.0, 0.0)
+        angle = 0.0
+        points = []
+        segment_count = 0
+        for symbol in symbols:
+            if symbol == '[':
+                stack.append((position, angle))
+            elif symbol == ']':
+                if not stack:
+                    raise ValueError(f'Brackets must be balanced within every rule, unmatched ] was found in {symbols}.')
+                position, angle = stack.pop()
+            else:
+                child = self.summary(symbol, depth)
+                for point in child.hull:
+                    point = rotate(point, angle)
+                    points.append((position[0] + point[0], position[1] + point[1]))
+                displacement = rotate(child.displacement, angle)
+                position = (position[0] + displacement[0], position[1] + displacement[1])
+                angle += child.turn
+                segment_count += child.segment_count
+        if stack:
+            raise ValueError(f'Brackets must be balanced within every rule, unmatched [ was found in {symbols}.')
+        return GeometrySummary(position, angle, convex_hull(points), segment_count)
+
+    def tree_summary(self, generations, starting_point=(0.0, 0.0), angle=0.0):
+        # Whole tree in screen coordinates: end point, end angle, bounding box and segment count
+        tree = self.compose(self.l_system.axiom, generations)
+        hull = [rotate(point, angle) for point in tree.hull]
+        displacement = rotate(tree.displacement, angle)
+        return {'end_point': (starting_point[0] + displacement[0], starting_point[1] + displacement[1]),
+                'end_angle': angle + tree.turn,
+                'bounding_box': bounding_box([(starting_point[0] + x, starting_point[1] + y) for x, y in hull]),
+                'segment_count': tree.segment_count}
+
+    def visible_segments(self, generations, starting_point, angle, viewport):
+        # Yields segments of the tree, subtrees whose bounding box misses viewport (left, top,
+        # right, bottom) are not expanded and are stepped over using their summary
+        left, top, right, bottom = viewport
+        position = starting_point
+        turtle_stack = []
+
+        def visible(symbol, depth):
+            # Called by expansion when it reaches the symbol, so turtle is already at its start
+            box = bounding_box([rotate(point, angle) for point in self.summary(symbol, depth).hull])
+            return (box is not None and
+                    position[0] + box[0] <= right and position[0] + box[2] >= left and
+                    position[1] + box[1] <= bottom and position[1] + box[3] >= top)
+
+        for symbol, depth in self.l_system.expand(generations, visible):
+            if symbol == '[':
+                turtle_stack.append((position, angle))
+            elif symbol == ']':
+                position, angle = turtle_stack.pop()
+            else:
+                child = self.summary(symbol, depth)
+                displacement = rotate(child.displacement, angle)
+                new_position = (position[0] + displacement[0], position[1] + displacement[1])
+                if depth == 0 and child.segment_count:
+                    yield position, new_position
+                position = new_position
+                angle += child.turn
+
+# Interpretation of whole code array at once peaks at roughly 112 bytes per symbol
+MAX_INTERPRETED_SYMBOLS = 4 * 10**6
+
+def expand_ranges(starts, lengths):
+    # Concatenation of arange(start, start + length) for all pairs without python loop
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return offsets + np.arange(lengths.sum())
+
+def restore_bracket_spans(values, codes, order, last_open):
+    # Each ] gets value cancelling everything accumulated since its [ so that cumulative sum
+    # returns to state stored by the bracket. Only symbols directly inside the brackets matter,
+    # nested spans cancel themselves, and in order sorted by depth these are exactly entries
+    # between the bracket pair.
+    sorted_sums = np.cumsum(values[order], axis=0)
+    closing = np.flatnonzero(codes[order] == ord(']'))
+    values = values.copy()
+    values[order[closing]] = sorted_sums[last_open[closing]] - sorted_sums[closing]
+    return values
+
+def interpret_segments(codes, initial_length, angle, starting_point, angle_step):
+    # Turtle interpretation of whole code array at once, returns drawn segments as rows
+    # (start_x, start_y, end_x, end_y)
+    codes = np.asarray(codes, dtype=np.uint8)
+    opening = codes == ord('[')
+    closing = codes == ord(']')
+    depth = np.cumsum(opening.astype(np.int64) - closing)
+    if np.any(depth < 0):
+        raise ValueError('Sequence closes bracket which was not opened.')
+    # Brackets belong to depth of the span they enclose
+    depth += closing
+    order = np.argsort(depth, kind='stable')
+    open_marks = np.where(codes[order] == ord('['), np.arange(len(codes)), -1)
+    last_open = np.maximum.accumulate(open_marks) if len(codes) else open_marks
+
+    turns = np.zeros(len(codes))
+    turns[codes == ord('+')] = -angle_step
+    turns[codes == ord('-')] = angle_step
+    angles = np.radians(angle + np.cumsum(restore_bracket_spans(turns, codes, order, last_open)))
+
+    moving = (codes == ord('F')) | (codes == ord('f'))
+    steps = np.zeros((len(codes), 2))
+    steps[moving, 0] = initial_length * np.cos(angles[moving])
+    steps[moving, 1] = -initial_length * np.sin(angles[moving])
+    positions = np.cumsum(restore_bracket_spans(steps, codes, order, last_open), axis=0)
+    positions += starting_point
+
+    drawing = codes == ord('F')
+    return np.hstack([positions[drawing] - steps[drawing], positions[drawing]])
+
+def draw_segments(surface, segments, color=BLACK, width=2, chunk_size=2**16):
+    # Rasterizes segments directly into surface pixels by sampling every segment once per pixel
+    # of its length and stamping square brush of given width on samples
+    surface_width, surface_height = surface.get_size()
+    brush = np.arange(width) - width // 2
+    brush_x, brush_y = [offsets.ravel() for offsets in np.meshgrid(brush, brush)]
+    pixels = pygame.surfarray.pixels2d(surface)
+    mapped_color = surface.map_rgb(color)
+    for first in range(0, len(segments), chunk_size):
+        chunk = segments[first:first + chunk_size]
+        deltas = chunk[:, 2:4] - chunk[:, 0:2]
+        sample_counts = np.ceil(np.abs(deltas).max(axis=1)).astype(np.int64) + 1
+        owners = np.repeat(np.arange(len(chunk)), sample_counts)
+        fractions = expand_ranges(np.zeros(len(chunk), dtype=np.int64), sample_counts) / np.maximum(sample_counts - 1, 1)[owners]
+        samples = chunk[owners, 0:2] + deltas[owners] * fractions[:, np.newaxis]
+        samples = np.round(samples).astype(np.int64)
+        xs = (samples[:, 0, np.newaxis] + brush_x).ravel()
+        ys = (samples[:, 1, np.newaxis] + brush_y).ravel()
+        inside = (xs >= 0) & (xs < surface_width) & (ys >= 0) & (ys < surface_height)
+        pixels[xs[inside], ys[inside]] = mapped_color
+    del pixels
+
+SEGMENT_BATCH = 4096
+
+def segment_batches(segments, batch_size=SEGMENT_BATCH):
+    for first in range(0, len(segments), batch_size):
+        yield segments[first:first + batch_size]
+
+def culled_segment_batches(geometry, generations, angle, starting_point, viewport, batch_size=SEGMENT_BATCH):
+    segments = geometry.visible_segments(generations, starting_point, angle, viewport)
+    while True:
+        batch = list(islice(segments, batch_size))
+        if not batch:
+            return
+        yield np.array([start + end for start, end in batch])
+
+def draw_progressively(window, batches, frame_budget):
+    # Draws batches of segments until time of one frame is used, returns whether something is
+    # left for next frame
+    deadline = time.perf_counter() + frame_budget
+    for batch in batches:
+        draw_segments(window, batch)
+        if time.perf_counter() >= deadline:
+            return True
+    return False
+#---------------------------------------------------------------------------------------------------
+#                                       BATCH GALLERY 
+#---------------------------------------------------------------------------------------------------
+DEFAULT_THUMBNAIL_SIZE = (256, 256)
+THUMBNAIL_MARGIN = 8
+
+def normalize_spec(spec):
+    # Fills defaults so that equal drawings always have equal spec and therefore equal hash
+    rules = spec.get('rules', DEFAULT_RULES)
+    if isinstance(rules, str):
+        rules = lsystem_rule_string(rules)
+    return {'rules': dict(sorted(rules.items())),
+            'axiom': spec.get('axiom', DEFAULT_AXIOM),
+            'angle_step': float(spec.get('angle_step', DEFAULT_ANGLE_STEP)),
+            'generations': int(spec.get('generations', DEFAULT_GENERATIONS))}
+
+def spec_hash(spec, thumbnail_size):
+    text = json.dumps({'spec': spec, 'size': list(thumbnail_size)}, sort_keys=True)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def render_thumbnail(spec, thumbnail_size, path):
+    # Tree is scaled and moved to fit thumbnail using its bounding box from geometry summaries
+    l_system = LSystem(spec['rules'], spec['axiom'])
+    geometry = LSystemGeometry(l_system, 1.0, spec['angle_step'])
+    symbol_count = l_system.symbol_count(spec['generations'])
+    if symbol_count > MAX_INTERPRETED_SYMBOLS:
+        raise ValueError(f'Tree has {symbol_count} symbols, which is more than {MAX_INTERPRETED_SYMBOLS} allowed in gallery.')
+    summary = geometry.tree_summary(spec['generations'], (0.0, 0.0), 90)
+
+    surface = pygame.Surface(thumbnail_size)
+    surface.fill(BG_COLOR)
+    if summary['bounding_box'] is not None:
+        left, top, right, bottom = summary['bounding_box']
+        free_width = thumbnail_size[0] - 2 * THUMBNAIL_MARGIN
+        free_height = thumbnail_size[1] - 2 * THUMBNAIL_MARGIN
+        scale = min(free_width / max(right - left, 1e-9), free_height / max(bottom - top, 1e-9))
+        starting_point = (thumbnail_size[0] / 2 - scale * (left + right) / 2,
+                          thumbnail_size[1] / 2 - scale * (top + bottom) / 2)
+        segments = interpret_segments(l_system.encode(spec['generations']), scale, 90, starting_point, spec['angle_step'])
+        draw_segments(surface, segments, width=1)
+    pygame.image.save(surface, path)
+    return summary['segment_count']
+
+def render_gallery_entry(task):
+    # Runs in worker process, failures are reported instead of raised so one spec does not stop
+    # the whole batch
+    spec, thumbnail_size, path = task
+    start = time.perf_counter()
+    try:
+        segment_count = render_thumbnail(spec, thumbnail_size, path)
+        return {'path': path, 'segments': segment_count, 'seconds': time.perf_counter() - start}
+    except Exception as e:
+        return {'path': path, 'error': f'{type(e).__name__} -> {e}'}
+
+def render_gallery(specs, output_dir, thumbnail_size=DEFAULT_THUMBNAIL_SIZE, workers=None):
+    # Thumbnails are named by hash of their spec, existing ones are not rendered again
+    os.makedirs(output_dir, exist_ok=True)
+    tasks = []
+    cached = []
+    for spec in specs:
+        spec = normalize_spec(spec)
+        path = os.path.join(output_dir, spec_hash(spec, thumbnail_size) + '.png')
+        if os.path.exists(path):
+            cached.append(path)
+        else:
+            tasks.append((spec, thumbnail_size, path))
+
+    results = []
+    if tasks:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(render_gallery_entry, tasks))
+    return results, cached
+
 #---------------------------------------------------------------------------------------------------
 #                                      MAIN FUNCTION 
 #---------------------------------------------------------------------------------------------------
 DEFAULT_AXIOM = 'F'
 DEFAULT_ANGLE_STEP = 90.0
+DEFAULT_GENERATIONS = 5
+DEFAULT_FRAME_BUDGET = 16.0
 
 def integer_pair(txt):
     values = txt.split('x')
@@ -105,30 +429,78 @@ def parse_arguments():
                         help='Axiom from which model will be grown')
     parser.add_argument('--angle_step', type=float, default=DEFAULT_ANGLE_STEP,
                         help='Angle at which drawing will move angle')
-    parser.add_argument('--g', '--generations', type=int, default=5,
+    parser.add_argument('-g', '--generations', type=int, default=DEFAULT_GENERATIONS,
                         help='Number of generation for which Lsystem will be ran.')
+    parser.add_argument('--gallery', type=str, default=None,
+                        help='JSON file with list of specs (rules, axiom, angle_step, generations) rendered to PNG thumbnails without window.')
+    parser.add_argument('--gallery_dir', type=str, default='gallery',
+                        help='Directory to which gallery thumbnails are written.')
+    parser.add_argument('--thumbnail_size', type=integer_pair, default=DEFAULT_THUMBNAIL_SIZE,
+                        help='Size of gallery thumbnails.')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of processes rendering gallery, by default all cores are used.')
+    parser.add_argument('--frame_budget', type=float, default=DEFAULT_FRAME_BUDGET,
+                        help='Milliseconds spent drawing in one frame, large trees appear over several frames.')
+    parser.add_argument('--culled', action='store_true',
+                        help='Expands only subtrees visible in window, faster when most of the tree is outside.')
+    parser.add_argument('--stats', action='store_true',
+                        help='Prints segment count, bounding box and end pose of the tree instead of drawing it.')
     return parser.parse_args()
 
 
-def main(args):
-    window = pygame.display.set_mode(args.window_size)
-    pygame.display.set_caption("Lindenmayer Tree")
+def run_gallery(args):
+    with open(args.gallery) as spec_file:
+        specs = json.load(spec_file)
+    start = time.perf_counter()
+    results, cached = render_gallery(specs, args.gallery_dir, args.thumbnail_size, args.workers)
+    for result in results:
+        if 'error' in result:
+            print(f'{result["path"]}: {result["error"]}')
+    rendered = sum('error' not in result for result in results)
+    print(f'{rendered} rendered, {len(cached)} cached, {len(results) - rendered} failed '
+          f'in {time.perf_counter() - start:.2f}s -> {args.gallery_dir}')
 
+def main(args):
+    if args.gallery is not None:
+        run_gallery(args)
+        return
 
     l_system = LSystem(args.rules, args.axiom)
+    geometry = LSystemGeometry(l_system, 10, args.angle_step)
+    if args.stats:
+        print(geometry.tree_summary(args.generations, args.starting_point, 90))
+        return
 
-    for _ in range(5):
-        l_system.step()
+    window = pygame.display.set_mode(args.window_size)
+    pygame.display.set_caption("Lindenmayer Tree")
 
     window.fill(BG_COLOR)
-    draw_tree(window, l_system.sequence, 10, 90, args.starting_point, args.angle_step)
+    symbol_count = l_system.symbol_count(args.generations)
+    if not args.culled and symbol_count > MAX_INTERPRETED_SYMBOLS:
+        print(f'Tree has {symbol_count} symbols, more than {MAX_INTERPRETED_SYMBOLS} interpreted at once, drawing it culled instead.')
+    if args.culled or symbol_count > MAX_INTERPRETED_SYMBOLS:
+        viewport = (0, 0) + window.get_size()
+        batches = culled_segment_batches(geometry, args.generations, 90, args.starting_point, viewport)
+    else:
+        segments = interpret_segments(l_system.encode(args.generations), 10, 90, args.starting_point, args.angle_step)
+        batches = segment_batches(segments)
 
-    # Keep the window open until the user closes it
+    # Tree is drawn over several frames so window keeps responding, once it is finished loop
+    # sleeps until some event arrives
+    drawing = True
     running = True
     while running:
-        for event in pygame.event.get():
+        if drawing:
+            drawing = draw_progressively(window, batches, args.frame_budget / 1000)
+            pygame.display.update()
+            events = pygame.event.get()
+        else:
+            events = [pygame.event.wait()]
+        for event in events:
             if event.type == pygame.QUIT:
                 running = False
+            elif event.type == pygame.VIDEOEXPOSE:
+                pygame.display.update()
 
     pygame.quit()
 
@@ -1,6 +1,7 @@
 import sys
 import pygame as pg
 import numpy as np
+from sweep_and_prune import SweepAndPrune, expand_ranges
 
 #===================================================================================================
 #                                                GLOBALS 
@@ -21,87 +22,239 @@ PARTICLE_RADIUS = 3
 TIME_SCALING = 0.001
 CUTOFF_DISTANCE  = 100.0
 VISCOSITY = 0.3
-
-particles = []
+# Upper bound of candidate pairs held in memory at once by force computation
+PAIR_BATCH_SIZE = 2**20
+COLLISIONS = False
 
 #===================================================================================================
 #                                            PARTICLE MODEL
 #===================================================================================================
+class ParticleStore:
+    '''
+    Keeps state of all particles in contiguous arrays, one row per particle.
+    '''
+
+    def __init__(self, capacity=0):
+        self.count = 0
+        self.positions = np.zeros((capacity, 2), dtype=np.float64)
+        self.velocities = np.zeros((capacity, 2), dtype=np.float64)
+        self.accelerations = np.zeros((capacity, 2), dtype=np.float64)
+        self.variants = np.zeros(capacity, dtype=np.int32)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for index in range(self.count):
+            yield Particle.view(self, index)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("particle index out of range")
+        return Particle.view(self, index)
+
+    def reserve(self, capacity):
+        if capacity <= len(self.variants):
+            return
+        capacity = max(capacity, 2 * len(self.variants))
+        for name in ('positions', 'velocities', 'accelerations', 'variants'):
+            array = getattr(self, name)
+            grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+            grown[:self.count] = array[:self.count]
+            setattr(self, name, grown)
+
+    def extend(self, variants, positions, velocities=None, accelerations=None):
+        # Adds particles in bulk and returns slice of rows they occupy
+        variants = np.asarray(variants)
+        first = self.count
+        last = first + len(variants)
+        self.reserve(last)
+        self.variants[first:last] = variants
+        self.positions[first:last] = positions
+        self.velocities[first:last] = 0.0 if velocities is None else velocities
+        self.accelerations[first:last] = 0.0 if accelerations is None else accelerations
+        self.count = last
+        return slice(first, last)
+
+    def append(self, particle):
+        # Copies particle into the store, afterwards particle is a view on its new row
+        rows = self.extend([particle.variant], [particle.position], [particle.velocity], [particle.acceleration])
+        particle.store = self
+        particle.id = rows.start
+
+    def clear(self):
+        self.count = 0
+
+    @property
+    def active_positions(self):
+        return self.positions[:self.count]
+
+    @property
+    def active_velocities(self):
+        return self.velocities[:self.count]
+
+    @property
+    def active_accelerations(self):
+        return self.accelerations[:self.count]
+
+    @property
+    def active_variants(self):
+        return self.variants[:self.count]
+
+
 class Particle:
+    '''
+    View on one row of a ParticleStore, vectors it returns alias the store arrays. Constructed
+    particle is kept in a store of its own and joins a simulation only once it is appended to
+    store of that simulation.
+    '''
 
-    last_id = 0
+    __slots__ = ('store', 'id')
 
     def __init__(self, 
                  variant=0,
-                 position=np.array([0.0, 0.0]),
-                 velocity=np.array([0.0, 0.0]),
-                 acceleration=np.array([0.0, 0.0])
+                 position=(0.0, 0.0),
+                 velocity=(0.0, 0.0),
+                 acceleration=(0.0, 0.0)
                  ):
-        self.id = Particle.last_id
-        Particle.last_id += 1
-        self.position = position
-        self.velocity = velocity
-        self.acceleration = acceleration
-        self.variant = variant
+        self.store = ParticleStore(capacity=1)
+        self.id = self.store.extend([variant], [position], [velocity], [acceleration]).start
+
+    @classmethod
+    def view(cls, store, index):
+        particle = cls.__new__(cls)
+        particle.store = store
+        particle.id = index
+        return particle
+
+    @property
+    def variant(self):
+        return int(self.store.variants[self.id])
+
+    @variant.setter
+    def variant(self, value):
+        self.store.variants[self.id] = value
+
+    @property
+    def position(self):
+        return self.store.positions[self.id]
+
+    @position.setter
+    def position(self, value):
+        self.store.positions[self.id] = value
+
+    @property
+    def velocity(self):
+        return self.store.velocities[self.id]
+
+    @velocity.setter
+    def velocity(self, value):
+        self.store.velocities[self.id] = value
+
+    @property
+    def acceleration(self):
+        return self.store.accelerations[self.id]
+
+    @acceleration.setter
+    def acceleration(self, value):
+        self.store.accelerations[self.id] = value
 
     def __eq__(self, other):
-        return self.id == other.id
+        return self.store is other.store and self.id == other.id
+
+    def __hash__(self):
+        return hash((id(self.store), self.id))
+
+
+particles = ParticleStore()
 
 def fill_with_random_particles(particle_count):
-    for _ in range(particle_count):
-        variant = np.random.randint(VARIANT_COUNT)
-        position = np.random.rand(2) * SIMULATION_SIZE
-        particles.append(Particle(variant, position))
+    variants = np.random.randint(VARIANT_COUNT, size=particle_count)
+    positions = np.random.rand(particle_count, 2) * SIMULATION_SIZE
+    particles.extend(variants, positions)
+
+
+def cell_grid_shape():
+    # Cells are at least CUTOFF_DISTANCE wide, so every interaction partner of a particle lies in
+    # its own cell or one of the eight cells around it.
+    return np.maximum((SIMULATION_SIZE // CUTOFF_DISTANCE).astype(np.int64), 1)
+
+
+def neighbour_cell_offsets(grid_shape):
+    # On grids narrower than three cells some of the offsets wrap onto the same cell, which must
+    # only be visited once.
+    offsets = {(offset_x % grid_shape[0], offset_y % grid_shape[1])
+               for offset_x in (-1, 0, 1)
+               for offset_y in (-1, 0, 1)}
+    return np.array(sorted(offsets), dtype=np.int64)
+
+
+def pair_batches(counts, batch_size=PAIR_BATCH_SIZE):
+    # Consecutive ranges of targets whose candidate counts sum to about batch_size, a target with
+    # more candidates than that forms a range of its own
+    cumulative = np.cumsum(counts)
+    total = cumulative[-1] if len(cumulative) else 0
+    bounds = np.unique(np.concatenate([[0], np.searchsorted(cumulative, np.arange(batch_size, total, batch_size)),
+                                       [len(counts)]]))
+    return zip(bounds[:-1], bounds[1:])
+
+
+def compute_forces(positions, variants):
+    particle_count = len(positions)
+    grid_shape = cell_grid_shape()
+    cells = (positions // (SIMULATION_SIZE / grid_shape)).astype(np.int64) % grid_shape
+    cell_ids = cells[:, 0] * grid_shape[1] + cells[:, 1]
+    order = np.argsort(cell_ids, kind='stable')
+    cell_starts = np.searchsorted(cell_ids[order], np.arange(grid_shape[0] * grid_shape[1] + 1))
+
+    forces = np.zeros((particle_count, 2))
+    for offset in neighbour_cell_offsets(grid_shape):
+        neighbour_cells = (cells + offset) % grid_shape
+        neighbour_ids = neighbour_cells[:, 0] * grid_shape[1] + neighbour_cells[:, 1]
+        starts = cell_starts[neighbour_ids]
+        ends = cell_starts[neighbour_ids + 1]
+        # Few large cells make candidate count grow with square of particle count, so targets
+        # are processed in batches
+        for first, last in pair_batches(ends - starts):
+            targets = np.repeat(np.arange(first, last), ends[first:last] - starts[first:last])
+            sources = order[expand_ranges(starts[first:last], ends[first:last])]
+
+            difference = positions[targets] - positions[sources]
+            difference -= SIMULATION_SIZE * np.round(difference / SIMULATION_SIZE)
+            distance2 = np.einsum('ij,ij->i', difference, difference)
+            inside = (distance2 <= CUTOFF_DISTANCE * CUTOFF_DISTANCE) & (targets != sources)
+            targets = targets[inside]
+            difference = difference[inside]
+            difference *= VARIANT_RELATIONS[variants[sources[inside]], variants[targets]][:, None]
+            forces[:, 0] += np.bincount(targets, weights=difference[:, 0], minlength=particle_count)
+            forces[:, 1] += np.bincount(targets, weights=difference[:, 1], minlength=particle_count)
+    return forces
+
+
+collisions = SweepAndPrune(PARTICLE_RADIUS, SIMULATION_SIZE)
 
 
 def update_particles(dt):
-    for target in particles:
-        total_force = [0.0, 0.0]
-        for source in particles:
-            if target == source:
-                continue
-            distance = np.linalg.norm(source.position-target.position)
-            if distance > CUTOFF_DISTANCE:
-                continue
-            distance_x = target.position[0] - source.position[0]
-            distance_y = target.position[1] - source.position[1]
-            force = distance * VARIANT_RELATIONS[source.variant, target.variant]
-            force_x = force * distance_x / distance
-            force_y = force * distance_y / distance
-            total_force[0] += force_x
-            total_force[1] += force_y
-        velocity = np.linalg.norm(target.velocity)
-        dampening = velocity * VISCOSITY
-        if total_force[0] > 0:
-            total_force[0] =  total_force[0] - dampening
-            if total_force[0] < 0:
-                total_force[0] = 0
-        if total_force[1] > 0:
-            total_force[1] =  total_force[0] - dampening
-            if total_force[1] < 0:
-                total_force[1] = 0
-        if total_force[0] < 0:
-            total_force[0] =  total_force[0] + dampening
-            if total_force[0] > 0:
-                total_force[0] = 0
-        if total_force[1] < 0:
-            total_force[1] =  total_force[0] + dampening
-            if total_force[1] > 0:
-                total_force[1] = 0
-        
-        target.acceleration = np.array(total_force)
-    
-    for particle in particles:
-        particle.velocity = particle.velocity + particle.acceleration * dt
-        particle.position = particle.position + particle.velocity * dt
-        while particle.position[0] < 0:
-            particle.position[0] = particle.position[0] + SIMULATION_SIZE[0]
-        while particle.position[0] > SIMULATION_SIZE[0]:
-            particle.position[0] = particle.position[0] - SIMULATION_SIZE[0]
-        while particle.position[1] < 0:
-            particle.position[1] = particle.position[1] + SIMULATION_SIZE[1]
-        while particle.position[1] > SIMULATION_SIZE[1]:
-            particle.position[1] = particle.position[1] - SIMULATION_SIZE[1]
+    if not particles:
+        return
+    positions = particles.active_positions
+    velocities = particles.active_velocities
+    accelerations = particles.active_accelerations
+
+    forces = compute_forces(positions, particles.active_variants)
+    dampening = np.linalg.norm(velocities, axis=1, keepdims=True) * VISCOSITY
+    np.abs(forces, out=accelerations)
+    accelerations -= dampening
+    np.maximum(accelerations, 0.0, out=accelerations)
+    accelerations *= np.sign(forces)
+
+    velocities += accelerations * dt
+    positions += velocities * dt
+    np.mod(positions, SIMULATION_SIZE, out=positions)
+    if COLLISIONS:
+        collisions.resolve(positions, velocities)
 
 
 #===================================================================================================
@@ -1,8 +1,19 @@
 import sys
+import os
+import json
+import time
+import csv
+import queue
+import threading
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import pygame as pg
 import numpy as np
-from scipy.spatial import distance_matrix
+from scipy.spatial import distance_matrix, cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from sweep_and_prune import SweepAndPrune, expand_ranges
 
 #===================================================================================================
 #                                                GLOBALS 
@@ -35,11 +46,23 @@ class ParticleModelConfiguration:
     MINIMUM_SIMULATION_SIZE = 100
     MAX_VARIANT_COUNT = 6
     DEFAULT_PARTICLE_COUNT = 100
+    FORCE_ENGINES = ('dense', 'barnes_hut', 'chunked')
+    DEFAULT_OPENING_ANGLE = 0.5
+    DEFAULT_MAX_FORCE_MEMORY = 256 * 2**20
+    INTEGRATORS = ('semi_implicit_euler', 'velocity_verlet')
+    MAX_SUBSTEPS = 64
 
     def __init__(self,
                  simulation_size=DEFAULT_SIMULATION_SIZE,
                  variaton_relations=DEFAULT_VARIANT_RELATIONS,
-                 particle_count=DEFAULT_PARTICLE_COUNT):
+                 particle_count=DEFAULT_PARTICLE_COUNT,
+                 force_engine=FORCE_ENGINES[0],
+                 opening_angle=DEFAULT_OPENING_ANGLE,
+                 max_force_memory=DEFAULT_MAX_FORCE_MEMORY,
+                 single_precision=False,
+                 integrator=INTEGRATORS[0],
+                 max_displacement=None,
+                 collision_radius=None):
         try:
             if (len(simulation_size) != 2 or
                 simulation_size[0] < self.MINIMUM_SIMULATION_SIZE or
@@ -60,6 +83,30 @@ class ParticleModelConfiguration:
                 raise ValueError(f'Particle count must be 1 or greater, however value {particle_count} was given.')
             self.particle_count = particle_count
 
+            if force_engine not in self.FORCE_ENGINES:
+                raise ValueError(f'Force engine must be one of {self.FORCE_ENGINES} however value {force_engine} was given.')
+            self.force_engine = force_engine
+
+            if opening_angle <= 0:
+                raise ValueError(f'Opening angle must be larger than 0 however value {opening_angle} was given.')
+            self.opening_angle = opening_angle
+
+            if max_force_memory <= 0:
+                raise ValueError(f'Memory limit for force computation must be larger than 0 however value {max_force_memory} was given.')
+            self.max_force_memory = max_force_memory
+            self.single_precision = single_precision
+
+            if integrator not in self.INTEGRATORS:
+                raise ValueError(f'Integrator must be one of {self.INTEGRATORS} however value {integrator} was given.')
+            self.integrator = integrator
+
+            if max_displacement is not None and max_displacement <= 0:
+                raise ValueError(f'Maximum displacement must be larger than 0 however value {max_displacement} was given.')
+            self.max_displacement = max_displacement
+
+            if collision_radius is not None and (collision_radius <= 0 or 4*collision_radius > min(simulation_size)):
+                raise ValueError(f'Collision radius must be larger than 0 and at most quarter of simulation size however value {collision_radius} was given.')
+            self.collision_radius = collision_radius
 
         except Exception as e:
             exception_type = type(e)
@@ -75,50 +122,676 @@ class ParticleModel:
     def __init__(self, cfg=ParticleModelConfiguration()):
         try:
             self.cfg = cfg
-            self.variants = np.random.randint(low=0, high=cfg.get_variant_count(), size=cfg.particle_count)
+            # Particles are kept sorted by variant so every pair of variants is a contiguous block
+            self.variants = np.sort(np.random.randint(low=0, high=cfg.get_variant_count(), size=cfg.particle_count))
+            self.variant_bounds = np.searchsorted(self.variants, np.arange(cfg.get_variant_count() + 1))
             positions_x = np.random.rand(1,cfg.particle_count)*cfg.simulation_size[0]
             positions_y = np.random.rand(1,cfg.particle_count)*cfg.simulation_size[1]
             other_values = np.zeros([4,cfg.particle_count])
             self.state = np.vstack([positions_x,positions_y,other_values])
-            self.force_base = np.zeros((self.variants.shape[0], self.variants.shape[0]), dtype=np.float64)
-            for y in range(self.variants.shape[0]):
-                for x in range(self.variants.shape[0]):
-                    self.force_base =  self.cfg.variaton_relations[self.variants[y]][self.variants[x]]
+            self.force_engines = {'dense': self.apply_dense_forces,
+                                  'barnes_hut': self.apply_barnes_hut_forces,
+                                  'chunked': self.apply_chunked_forces}
+            self.integrators = {'semi_implicit_euler': self.integrate_semi_implicit_euler,
+                                'velocity_verlet': self.integrate_velocity_verlet}
+            # Rows of state are 0-1 position, 2-3 velocity and 4-5 acceleration, all updated in place
+            self.integration_buffer = np.zeros((2, cfg.particle_count))
+            self.forces_current = False
+            self.collisions = None
+            if cfg.collision_radius is not None:
+                self.collisions = SweepAndPrune(cfg.collision_radius, cfg.simulation_size)
 
         except Exception as e:
             exception_type = type(e)
             raise exception_type(f'During initialization of particle model exception occured {type(e).__name__} -> {e}')
 
+    def load_particles(self, state, variants):
+        # State array is used as is (not copied), so it can live for example in shared memory
+        try:
+            if state.shape != (6, self.cfg.particle_count):
+                raise ValueError(f'State must have shape {(6, self.cfg.particle_count)} however shape {state.shape} was given.')
+            if variants.shape != (self.cfg.particle_count,) or np.any(np.diff(variants) < 0):
+                raise ValueError('Variants must be given for every particle and sorted.')
+            self.state = state
+            self.variants = variants
+            self.variant_bounds = np.searchsorted(self.variants, np.arange(self.cfg.get_variant_count() + 1))
+            self.forces_current = False
+        except Exception as e:
+            exception_type = type(e)
+            raise exception_type(f'During loading of particles exception occured {type(e).__name__} -> {e}')
+
     def update_model(self, dt):
+        # Displacement estimate needs acceleration at current positions
+        if not self.forces_current:
+            self.apply_external_forces()
+            self.forces_current = True
+        substeps = self.get_substep_count(dt)
+        for _ in range(substeps):
+            self.integrators[self.cfg.integrator](dt / substeps)
+            # Separating overlapping particles moves them, so forces have to be evaluated again
+            if (self.collisions is not None and
+                self.collisions.resolve(self.state[0:2,:].transpose(), self.state[2:4,:].transpose())):
+                self.forces_current = False
+
+    def get_substep_count(self, dt):
+        # Splits dt so that no particle is expected to move further than allowed displacement
+        if self.cfg.max_displacement is None or dt <= 0:
+            return 1
+        speed = np.sqrt(np.max(self.state[2,:]**2 + self.state[3,:]**2))
+        acceleration = np.sqrt(np.max(self.state[4,:]**2 + self.state[5,:]**2))
+        displacement = speed*dt + 0.5*acceleration*dt*dt
+        return int(np.clip(np.ceil(displacement / self.cfg.max_displacement), 1, self.cfg.MAX_SUBSTEPS))
+
+    def wrap_positions(self):
+        np.remainder(self.state[0,:], self.cfg.simulation_size[0], out=self.state[0,:])
+        np.remainder(self.state[1,:], self.cfg.simulation_size[1], out=self.state[1,:])
+
+    def integrate_semi_implicit_euler(self, dt):
+        if not self.forces_current:
+            self.apply_external_forces()
+        np.multiply(self.state[4:6,:], dt, out=self.integration_buffer)
+        np.add(self.state[2:4,:], self.integration_buffer, out=self.state[2:4,:])
+        np.multiply(self.state[2:4,:], dt, out=self.integration_buffer)
+        np.add(self.state[0:2,:], self.integration_buffer, out=self.state[0:2,:])
+        self.wrap_positions()
+        self.forces_current = False
+
+    def integrate_velocity_verlet(self, dt):
+        if not self.forces_current:
+            self.apply_external_forces()
+        # Drift with old acceleration, then kick velocity with average of old and new one
+        np.multiply(self.state[4:6,:], 0.5*dt, out=self.integration_buffer)
+        np.add(self.integration_buffer, self.state[2:4,:], out=self.integration_buffer)
+        np.multiply(self.integration_buffer, dt, out=self.integration_buffer)
+        np.add(self.state[0:2,:], self.integration_buffer, out=self.state[0:2,:])
+        self.wrap_positions()
+        np.multiply(self.state[4:6,:], 0.5*dt, out=self.integration_buffer)
+        np.add(self.state[2:4,:], self.integration_buffer, out=self.state[2:4,:])
         self.apply_external_forces()
-        self.update_inertial_model(dt)
-
-    def update_inertial_model(self, dt):
-        transformation_matrix = np.array([[1.0, 0.0, dt, 0.0, dt*dt, 0.0],
-                                         [0.0, 1.0, 0.0, dt, 0.0, dt*dt],
-                                         [0.0, 0.0, 1.0, 0.0, dt, 0.0],
-                                         [0.0, 0.0, 0.0, 1.0, 0.0, dt],
-                                         [0.0, 0.0, 0.0, 0.0, 0.0, 0.0],
-                                         [0.0, 0.0, 0.0, 0.0, 0.0, 0.0]])
-        self.state = transformation_matrix @ self.state
-        self.state[0,:] = np.remainder(self.state[0,:], self.cfg.simulation_size[0])
-        self.state[1,:] = np.remainder(self.state[1,:], self.cfg.simulation_size[1])
+        np.multiply(self.state[4:6,:], 0.5*dt, out=self.integration_buffer)
+        np.add(self.state[2:4,:], self.integration_buffer, out=self.state[2:4,:])
+        self.forces_current = True
 
     def apply_external_forces(self):
+        self.force_engines[self.cfg.force_engine]()
+
+    def variant_blocks(self, start=0, stop=None):
+        # Variants with their particle ranges clipped to [start, stop), ranges are relative to start
+        stop = self.cfg.particle_count if stop is None else stop
+        for variant in range(self.cfg.get_variant_count()):
+            first = max(self.variant_bounds[variant], start)
+            last = min(self.variant_bounds[variant+1], stop)
+            if first < last:
+                yield variant, slice(first - start, last - start)
+
+    def apply_variant_relations(self, force, targets_start=0, targets_stop=None):
+        # Scales rows of sources and columns of targets by coefficient of their variants
+        for source_variant, sources in self.variant_blocks():
+            for target_variant, targets in self.variant_blocks(targets_start, targets_stop):
+                force[sources, targets] *= self.cfg.variaton_relations[source_variant, target_variant]
+
+    def apply_dense_forces(self):
+        # Force magnitude falls off as 1/distance and pushes target away from source for positive relation
         position_vector = self.state[:2,:].transpose()
         distance = distance_matrix(position_vector, position_vector)
-        force = np.divide(self.force_base,
-                          distance
-                          )
-        force = np.where(force==np.Inf, 0.0, force)
-        factor_x = distance / np.broadcast_to(position_vector[:,0],(position_vector.shape[0],position_vector.shape[0]))
-        factor_y = distance / np.broadcast_to(position_vector[:,1],(position_vector.shape[0],position_vector.shape[0]))
+        with np.errstate(divide='ignore'):
+            force = np.divide(1.0,
+                              distance * distance
+                              )
+        force[~np.isfinite(force)] = 0.0
+        self.apply_variant_relations(force)
+        factor_x = position_vector[np.newaxis,:,0] - position_vector[:,np.newaxis,0]
+        factor_y = position_vector[np.newaxis,:,1] - position_vector[:,np.newaxis,1]
+
+        self.state[-2,:] = np.sum(force * factor_x, axis=0)
+        self.state[-1,:] = np.sum(force * factor_y, axis=0)
+
+    # Buffers of size N x block used by chunked engine: two displacements, distance and forces
+    CHUNK_BUFFER_COUNT = 4
+
+    def get_force_block_size(self):
+        itemsize = np.dtype(np.float32 if self.cfg.single_precision else np.float64).itemsize
+        block = self.cfg.max_force_memory // (self.CHUNK_BUFFER_COUNT * itemsize * self.cfg.particle_count)
+        return int(np.clip(block, 1, self.cfg.particle_count))
+
+    def apply_chunked_forces(self):
+        # Same forces as dense engine computed for blocks of target columns at a time
+        dtype = np.float32 if self.cfg.single_precision else np.float64
+        position_vector = self.state[:2,:].transpose().astype(dtype)
+        block = self.get_force_block_size()
+        buffers = np.empty((self.CHUNK_BUFFER_COUNT, self.cfg.particle_count, block), dtype=dtype)
+        for start in range(0, self.cfg.particle_count, block):
+            targets = slice(start, min(start + block, self.cfg.particle_count))
+            width = targets.stop - start
+            factor_x, factor_y, distance_squared, force = buffers[:, :, :width]
+            np.subtract(position_vector[np.newaxis,targets,0], position_vector[:,np.newaxis,0], out=factor_x)
+            np.subtract(position_vector[np.newaxis,targets,1], position_vector[:,np.newaxis,1], out=factor_y)
+            np.multiply(factor_x, factor_x, out=distance_squared)
+            np.multiply(factor_y, factor_y, out=force)
+            np.add(distance_squared, force, out=distance_squared)
+            force[...] = 0.0
+            np.divide(1.0, distance_squared, out=force, where=distance_squared > 0)
+            self.apply_variant_relations(force, targets.start, targets.stop)
+            self.state[-2,targets] = np.sum(np.multiply(force, factor_x, out=factor_x), axis=0)
+            self.state[-1,targets] = np.sum(np.multiply(force, factor_y, out=factor_y), axis=0)
+
+    def apply_barnes_hut_forces(self):
+        tree = BarnesHutTree(self.state[:2,:].transpose(), self.variants, self.cfg.variaton_relations)
+        self.state[-2:,:] = tree.accelerations(self.cfg.opening_angle).transpose()
+
+
+def interleave_bits(x, y):
+    # Morton code of 16 bit cell coordinates
+    codes = np.zeros(x.shape, dtype=np.int64)
+    for bit in range(16):
+        codes |= ((x >> bit) & 1) << (2*bit)
+        codes |= ((y >> bit) & 1) << (2*bit + 1)
+    return codes
+
+class BarnesHutTree:
+    '''
+    Quadtree over particles sorted by Morton code. Every node keeps particle count and centre
+    of mass per variant, so far away nodes can stand in for all their particles even though
+    force depends on variant of source. Targets are taken from the same tree, node by node:
+    source node far from target node acts on it through a linear expansion of its field around
+    target node centre, which is then passed down to children and finally to particles.
+    '''
+
+    LEAF_SIZE = 16
+    MAX_DEPTH = 16
+    DIRECT_CHUNK = 2**17
+    FAR_CHUNK = 2**15
+
+    def __init__(self, positions, variants, variaton_relations):
+        self.relations = variaton_relations
+        variant_count = variaton_relations.shape[0]
+        particle_count = positions.shape[0]
+        lower = positions.min(axis=0)
+        extent = max(float((positions.max(axis=0) - lower).max()), 1.0) * (1 + 1e-9)
+        depth = int(np.clip(np.ceil(np.log(max(particle_count / self.LEAF_SIZE, 1)) / np.log(4)) + 2,
+                            1, self.MAX_DEPTH))
+        cells = np.clip(((positions - lower) / extent * 2**depth).astype(np.int64), 0, 2**depth - 1)
+        codes = interleave_bits(cells[:,0], cells[:,1])
+        self.order = np.argsort(codes, kind='stable')
+        self.positions = positions[self.order]
+        self.variants = variants[self.order]
+        codes = codes[self.order]
+        cells = cells[self.order]
+
+        levels = []
+        node_offset = 0
+        for level in range(depth + 1):
+            level_codes = codes >> (2*(depth - level))
+            first = np.flatnonzero(np.r_[True, level_codes[1:] != level_codes[:-1]])
+            last = np.r_[first[1:], particle_count]
+            node_of_particle = np.cumsum(np.r_[True, level_codes[1:] != level_codes[:-1]]) - 1
+            node_count = first.shape[0]
+            slots = node_of_particle * variant_count + self.variants
+            counts = np.bincount(slots, minlength=node_count*variant_count).reshape(node_count, variant_count)
+            sums = np.stack([np.bincount(slots, self.positions[:,axis], node_count*variant_count)
+                             for axis in range(2)], axis=-1).reshape(node_count, variant_count, 2)
+            size = extent / 2**level
+            levels.append({
+                'codes': level_codes[first],
+                'offset': node_offset,
+                'first': first,
+                'last': last,
+                'counts': counts,
+                'sums': sums,
+                'origin': lower + (cells[first] >> (depth - level)) * size,
+                'size': np.full(node_count, size),
+                'leaf': (last - first <= self.LEAF_SIZE) | (level == depth)
+            })
+            node_offset += node_count
+
+        # Children of node are contiguous in next level because codes are sorted
+        for level, next_level in zip(levels[:-1], levels[1:]):
+            parent_codes = next_level['codes'] >> 2
+            level['child_first'] = np.searchsorted(parent_codes, level['codes'], 'left') + next_level['offset']
+            level['child_last'] = np.searchsorted(parent_codes, level['codes'], 'right') + next_level['offset']
+        levels[-1]['child_first'] = levels[-1]['child_last'] = np.zeros(levels[-1]['codes'].shape[0], dtype=np.int64)
+
+        def merge(key):
+            return np.concatenate([level[key] for level in levels])
+        self.particle_first = merge('first')
+        self.particle_last = merge('last')
+        self.child_first = merge('child_first')
+        self.child_last = merge('child_last')
+        self.origin = merge('origin')
+        self.size = merge('size')
+        self.leaf = merge('leaf')
+        self.counts = merge('counts')
+        sums = merge('sums')
+        total_counts = self.counts.sum(axis=1)
+        self.total_centres = sums.sum(axis=1) / total_counts[:,np.newaxis]
+        # Variants missing from node get its total centre, their zero count then cancels them out
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.centres = np.where(self.counts[:,:,np.newaxis] > 0, sums / self.counts[:,:,np.newaxis],
+                                    self.total_centres[:,np.newaxis,:])
+
+    def accelerations(self, opening_angle):
+        # Pairs of target and source nodes are walked from (root, root). Well separated pair is
+        # evaluated once as linear expansion around target node centre, otherwise larger node is
+        # split, and pairs of leaves are summed over all particle pairs
+        variant_count = self.relations.shape[0]
+        sorted_accelerations = np.zeros_like(self.positions)
+        # Per node and target variant: field (x, y) at node centre and its gradient, which is
+        # symmetric and traceless, so two numbers (xx, xy) describe it
+        fields = np.zeros((self.size.shape[0], variant_count, 4))
+        node_centres = self.origin + 0.5*self.size[:,np.newaxis]
+        direct_targets = []
+        direct_sources = []
+        targets = np.zeros(1, dtype=np.int64)
+        sources = np.zeros(1, dtype=np.int64)
+        while targets.shape[0] > 0:
+            target_sizes = self.size[targets]
+            source_sizes = self.size[sources]
+            delta = node_centres[targets] - self.total_centres[sources]
+            extent = target_sizes + source_sizes
+            separated = extent*extent < opening_angle*opening_angle*(delta[:,0]*delta[:,0] + delta[:,1]*delta[:,1])
+            self.add_far_fields(fields, targets[separated], sources[separated], node_centres)
+
+            target_leaf = self.leaf[targets]
+            source_leaf = self.leaf[sources]
+            direct = ~separated & target_leaf & source_leaf
+            direct_targets.append(targets[direct])
+            direct_sources.append(sources[direct])
+            split_target = ~separated & ~direct & ~target_leaf & (source_leaf | (target_sizes >= source_sizes))
+            split_source = ~separated & ~direct & ~split_target
+
+            nodes = targets[split_target]
+            child_counts = self.child_last[nodes] - self.child_first[nodes]
+            next_targets = [expand_ranges(self.child_first[nodes], self.child_last[nodes])]
+            next_sources = [np.repeat(sources[split_target], child_counts)]
+            nodes = sources[split_source]
+            child_counts = self.child_last[nodes] - self.child_first[nodes]
+            next_targets.append(np.repeat(targets[split_source], child_counts))
+            next_sources.append(expand_ranges(self.child_first[nodes], self.child_last[nodes]))
+            targets = np.concatenate(next_targets)
+            sources = np.concatenate(next_sources)
+
+        self.add_direct_forces(sorted_accelerations, np.concatenate(direct_targets), np.concatenate(direct_sources))
+        self.add_expansions(sorted_accelerations, fields, node_centres)
+        accelerations = np.empty_like(sorted_accelerations)
+        accelerations[self.order] = sorted_accelerations
+        return accelerations
+
+    def add_far_fields(self, fields, targets, sources, node_centres):
+        # Every variant of source node acts through its centre of mass, contributions are mixed
+        # into fields felt by each target variant with one matrix product. Pairs are taken in
+        # chunks of bounded size
+        variant_count = self.relations.shape[0]
+        flat_fields = fields.reshape(fields.shape[0], -1)
+        for first in range(0, targets.shape[0], self.FAR_CHUNK):
+            chunk_targets = targets[first:first+self.FAR_CHUNK]
+            chunk_sources = sources[first:first+self.FAR_CHUNK]
+            delta = node_centres[chunk_targets][:,np.newaxis,:] - self.centres[chunk_sources]
+            distance_squared = delta[:,:,0]*delta[:,:,0] + delta[:,:,1]*delta[:,:,1]
+            weight = self.counts[chunk_sources] / distance_squared
+            gradient_weight = weight / distance_squared
+            terms = np.stack([weight*delta[:,:,0],
+                              weight*delta[:,:,1],
+                              gradient_weight*(delta[:,:,1]*delta[:,:,1] - delta[:,:,0]*delta[:,:,0]),
+                              -2*gradient_weight*delta[:,:,0]*delta[:,:,1]], axis=1)
+            terms = (terms.reshape(-1, variant_count) @ self.relations).reshape(chunk_targets.shape[0], 4, variant_count)
+            terms = terms.transpose(0, 2, 1).reshape(chunk_targets.shape[0], 4*variant_count)
+            for column in range(flat_fields.shape[1]):
+                flat_fields[:,column] += np.bincount(chunk_targets, terms[:,column], flat_fields.shape[0])
+
+    def add_direct_forces(self, accelerations, target_nodes, source_nodes):
+        # Pairs of leaves are expanded into particle pairs in chunks of bounded size. Sums are kept
+        # per source variant and mixed by relations once per particle, not once per pair
+        particle_count = self.positions.shape[0]
+        variant_count = self.relations.shape[0]
+        positions_x = self.positions[:,0].copy()
+        positions_y = self.positions[:,1].copy()
+        sums = np.zeros((2, particle_count*variant_count))
+        target_counts = self.particle_last[target_nodes] - self.particle_first[target_nodes]
+        source_counts = self.particle_last[source_nodes] - self.particle_first[source_nodes]
+        pair_counts = target_counts * source_counts
+        cumulative = np.cumsum(pair_counts)
+        bounds = np.unique(np.r_[0, np.searchsorted(cumulative, np.arange(self.DIRECT_CHUNK, cumulative[-1], self.DIRECT_CHUNK)),
+                                 pair_counts.shape[0]]) if pair_counts.shape[0] else [0]
+        for chunk_start, chunk_end in zip(bounds[:-1], bounds[1:]):
+            chunk = slice(chunk_start, chunk_end)
+            # Every target particle of a leaf pair meets whole range of source particles
+            rows = np.repeat(source_nodes[chunk], target_counts[chunk])
+            targets = np.repeat(expand_ranges(self.particle_first[target_nodes[chunk]], self.particle_last[target_nodes[chunk]]),
+                                self.particle_last[rows] - self.particle_first[rows])
+            sources = expand_ranges(self.particle_first[rows], self.particle_last[rows])
+            delta_x = positions_x[targets] - positions_x[sources]
+            delta_y = positions_y[targets] - positions_y[sources]
+            distance_squared = delta_x*delta_x + delta_y*delta_y
+            with np.errstate(divide='ignore'):
+                weight = np.where(distance_squared > 0, 1.0 / distance_squared, 0.0)
+            slots = targets*variant_count + self.variants[sources]
+            sums[0] += np.bincount(slots, weight*delta_x, sums.shape[1])
+            sums[1] += np.bincount(slots, weight*delta_y, sums.shape[1])
+        sums = sums.reshape(2, particle_count, variant_count)
+        mixing = self.relations[:,self.variants].transpose()
+        accelerations += np.einsum('dpv,pv->pd', sums, mixing)
+
+    def add_expansions(self, accelerations, fields, node_centres):
+        # Expansions are shifted from parents into children down to the topmost leaves, where
+        # they are evaluated for every particle
+        nodes = np.zeros(1, dtype=np.int64)
+        while nodes.shape[0] > 0:
+            leaves = nodes[self.leaf[nodes]]
+            particles = expand_ranges(self.particle_first[leaves], self.particle_last[leaves])
+            owners = np.repeat(leaves, self.particle_last[leaves] - self.particle_first[leaves])
+            accelerations[particles] += self.expand_field(fields[owners, self.variants[particles]],
+                                                          self.positions[particles] - node_centres[owners])
+
+            parents = nodes[~self.leaf[nodes]]
+            nodes = expand_ranges(self.child_first[parents], self.child_last[parents])
+            owners = np.repeat(parents, self.child_last[parents] - self.child_first[parents])
+            shifted = fields[owners]
+            shifted[:,:,0:2] = self.expand_field(shifted, (node_centres[nodes] - node_centres[owners])[:,np.newaxis,:])
+            fields[nodes] += shifted
+
+    @staticmethod
+    def expand_field(fields, offsets):
+        # Value of linear expansion (x, y, xx, xy) at given offset from its centre
+        return np.stack([fields[...,0] + fields[...,2]*offsets[...,0] + fields[...,3]*offsets[...,1],
+                         fields[...,1] + fields[...,3]*offsets[...,0] - fields[...,2]*offsets[...,1]], axis=-1)
 
-        self.state[-1,:] = np.sum(force * factor_x, axis=0)
-        self.state[-2,:] = np.sum(force * factor_y, axis=0)
 
-        #force = force.sum(axis=0)        
-        #self.state[-2:,:] = force
+#===================================================================================================
+#                                  HEADLESS SIMULATION AND TRAJECTORIES
+#===================================================================================================
+
+class TrajectoryRecorder:
+    '''
+    Writes positions and velocities of every n-th step to memory mapped chunk files from
+    background thread. Variants do not change during simulation so they are saved once.
+    '''
+
+    METADATA_FILE = 'trajectory.json'
+    VARIANTS_FILE = 'variants.npy'
+    CHUNK_FILE = 'chunk_{:06d}.npy'
+    DEFAULT_CHUNK_SIZE = 256
+    DEFAULT_QUEUE_SIZE = 16
+
+    def __init__(self, path, model, dt, every=1, chunk_size=DEFAULT_CHUNK_SIZE, queue_size=DEFAULT_QUEUE_SIZE):
+        try:
+            if every < 1:
+                raise ValueError(f'Recording interval must be 1 or greater however value {every} was given.')
+            if chunk_size < 1:
+                raise ValueError(f'Chunk size must be 1 or greater however value {chunk_size} was given.')
+            os.makedirs(path, exist_ok=True)
+            self.path = path
+            self.every = every
+            self.chunk_size = chunk_size
+            self.metadata = {
+                'frame_count': 0,
+                'chunk_size': chunk_size,
+                'particle_count': model.cfg.particle_count,
+                'simulation_size': list(model.cfg.simulation_size),
+                'variaton_relations': model.cfg.variaton_relations.tolist(),
+                'frame_time': dt * every,
+                'steps': []
+            }
+            np.save(os.path.join(path, self.VARIANTS_FILE), model.variants)
+            self.chunk = None
+            self.error = None
+            self.frames = queue.Queue(maxsize=queue_size)
+            self.writer = threading.Thread(target=self.write_frames, daemon=True)
+            self.writer.start()
+        except Exception as e:
+            exception_type = type(e)
+            raise exception_type(f'During initialization of trajectory recorder exception occured {type(e).__name__} -> {e}')
+
+    def record(self, step_index, state):
+        if self.error is not None:
+            raise self.error
+        if step_index % self.every == 0:
+            self.frames.put((step_index, state[:4,:].copy()))
+
+    def close(self):
+        if self.writer.is_alive():
+            self.frames.put(None)
+        self.writer.join()
+        if self.error is not None:
+            raise self.error
+
+    def write_frames(self):
+        frame = ()
+        try:
+            while True:
+                frame = self.frames.get()
+                if frame is None:
+                    break
+                self.write_frame(*frame)
+            self.chunk = None
+            self.write_metadata()
+        except Exception as e:
+            self.error = e
+            # Queue is drained until close, otherwise record and close would block on full queue forever
+            while frame is not None:
+                frame = self.frames.get()
+
+    def write_frame(self, step_index, frame):
+        chunk_index, offset = divmod(self.metadata['frame_count'], self.chunk_size)
+        if offset == 0:
+            self.chunk = np.lib.format.open_memmap(os.path.join(self.path, self.CHUNK_FILE.format(chunk_index)),
+                                                   mode='w+', dtype=frame.dtype,
+                                                   shape=(self.chunk_size,) + frame.shape)
+        self.chunk[offset] = frame
+        self.metadata['frame_count'] += 1
+        self.metadata['steps'].append(step_index)
+        if offset == self.chunk_size - 1:
+            self.chunk.flush()
+            self.chunk = None
+            self.write_metadata()
+
+    def write_metadata(self):
+        with open(os.path.join(self.path, self.METADATA_FILE), 'w') as metadata_file:
+            json.dump(self.metadata, metadata_file)
+
+
+class Trajectory:
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, TrajectoryRecorder.METADATA_FILE)) as metadata_file:
+            self.metadata = json.load(metadata_file)
+        self.frame_count = self.metadata['frame_count']
+        self.chunk_size = self.metadata['chunk_size']
+        self.frame_time = self.metadata['frame_time']
+        self.variants = np.load(os.path.join(path, TrajectoryRecorder.VARIANTS_FILE))
+        self.chunks = {}
+
+    def __len__(self):
+        return self.frame_count
+
+    def __getitem__(self, index):
+        # Rows of frame are positions x and y followed by velocities x and y
+        if index < 0:
+            index += self.frame_count
+        if not 0 <= index < self.frame_count:
+            raise IndexError(f'Frame {index} is outside of trajectory with {self.frame_count} frames.')
+        chunk_index, offset = divmod(index, self.chunk_size)
+        if chunk_index not in self.chunks:
+            self.chunks[chunk_index] = np.load(os.path.join(self.path, TrajectoryRecorder.CHUNK_FILE.format(chunk_index)),
+                                               mmap_mode='r')
+        return self.chunks[chunk_index][offset]
+
+    def get_configuration(self):
+        return ParticleModelConfiguration(simulation_size=tuple(self.metadata['simulation_size']),
+                                          variaton_relations=np.array(self.metadata['variaton_relations']),
+                                          particle_count=self.metadata['particle_count'])
+
+
+class HeadlessSimulation:
+
+    def __init__(self, model, dt, steps, recorder=None):
+        try:
+            if dt <= 0:
+                raise ValueError(f'Timestep must be larger than 0 however value {dt} was given.')
+            if steps < 1:
+                raise ValueError(f'Step count must be 1 or greater however value {steps} was given.')
+            self.model = model
+            self.dt = dt
+            self.steps = steps
+            self.recorder = recorder
+        except Exception as e:
+            exception_type = type(e)
+            raise exception_type(f'During initialization of headless simulation exception occured {type(e).__name__} -> {e}')
+
+    def run(self):
+        start = time.perf_counter()
+        if self.recorder is not None:
+            self.recorder.record(0, self.model.state)
+        for step in range(1, self.steps + 1):
+            self.model.update_model(self.dt)
+            if self.recorder is not None:
+                self.recorder.record(step, self.model.state)
+        elapsed = time.perf_counter() - start
+        return {'steps': self.steps, 'elapsed': elapsed, 'steps_per_second': self.steps / elapsed}
+
+
+class ReplayModel:
+    '''
+    Stands in for particle model in user interface, instead of computing physics it moves
+    through recorded trajectory at playback speed.
+    '''
+
+    def __init__(self, trajectory, speed=1.0):
+        self.trajectory = trajectory
+        self.cfg = trajectory.get_configuration()
+        self.variants = trajectory.variants
+        self.state = np.zeros((6, self.cfg.particle_count))
+        self.speed = speed
+        self.paused = False
+        self.time = 0.0
+        self.frame = -1
+        self.show_frame(0)
+
+    def load_frame(self, frame):
+        frame = int(np.clip(frame, 0, len(self.trajectory) - 1))
+        if frame != self.frame:
+            self.state[:4,:] = self.trajectory[frame]
+            self.frame = frame
+
+    def show_frame(self, frame):
+        self.load_frame(frame)
+        self.time = self.frame * self.trajectory.frame_time
+
+    def scrub(self, frames):
+        self.show_frame(self.frame + frames)
+
+    def update_model(self, dt):
+        if self.paused:
+            return
+        # Playback stops at last frame, time is kept there so scrubbing back works as expected
+        self.time = min(self.time + dt * self.speed, (len(self.trajectory) - 1) * self.trajectory.frame_time)
+        self.load_frame(int(self.time / self.trajectory.frame_time))
+
+
+#===================================================================================================
+#                                            PARAMETER SWEEP
+#===================================================================================================
+
+def sweep_metrics(model, linking_distance, min_cluster_size):
+    # Clusters are groups of particles linked by chains of neighbours closer than linking distance
+    positions = np.remainder(model.state[:2,:].transpose(), model.cfg.simulation_size)
+    tree = cKDTree(positions, boxsize=model.cfg.simulation_size)
+    pairs = tree.query_pairs(linking_distance, output_type='ndarray')
+    links = coo_matrix((np.ones(pairs.shape[0]), (pairs[:,0], pairs[:,1])),
+                       shape=(model.cfg.particle_count, model.cfg.particle_count))
+    _, labels = connected_components(links, directed=False)
+    neighbour_distance, _ = tree.query(positions, k=2)
+    return {
+        'cluster_count': int(np.count_nonzero(np.bincount(labels) >= min_cluster_size)),
+        'mean_neighbour_distance': float(neighbour_distance[:,1].mean()),
+        'kinetic_energy': float(0.5 * np.sum(model.state[2:4,:]**2) / model.cfg.particle_count)
+    }
+
+# Set separately in every worker process by init_sweep_worker
+sweep_worker_context = {}
+
+def init_sweep_worker(shared_name, states_shape, variants, model_options, dt, steps, linking_distance, min_cluster_size):
+    shared_states = shared_memory.SharedMemory(name=shared_name)
+    sweep_worker_context.update(
+        shared_states=shared_states,
+        states=np.ndarray(states_shape, dtype=np.float64, buffer=shared_states.buf),
+        variants=variants,
+        model_options=model_options,
+        dt=dt,
+        steps=steps,
+        linking_distance=linking_distance,
+        min_cluster_size=min_cluster_size)
+
+def run_sweep_member(task):
+    index, variaton_relations = task
+    context = sweep_worker_context
+    model = ParticleModel(ParticleModelConfiguration(variaton_relations=variaton_relations, **context['model_options']))
+    # Model steps directly in its slot of shared state array
+    model.load_particles(context['states'][index], context['variants'])
+    for _ in range(context['steps']):
+        model.update_model(context['dt'])
+    metrics = sweep_metrics(model, context['linking_distance'], context['min_cluster_size'])
+    return dict(run=index, **metrics)
+
+
+class ParameterSweep:
+    '''
+    Runs the same initial particles with many relation matrices on process pool. States of all
+    runs are kept in one shared memory array, so workers write them in place and only
+    metrics are sent back.
+    '''
+
+    DEFAULT_LINKING_DISTANCE = 10.0
+    DEFAULT_MIN_CLUSTER_SIZE = 3
+
+    def __init__(self, relation_matrices, dt, steps, model_options=None, workers=None,
+                 linking_distance=DEFAULT_LINKING_DISTANCE, min_cluster_size=DEFAULT_MIN_CLUSTER_SIZE):
+        try:
+            if len(relation_matrices) < 1:
+                raise ValueError('Sweep needs at least one relation matrix.')
+            self.relation_matrices = [np.array(relations, dtype=np.float64) for relations in relation_matrices]
+            if len({relations.shape for relations in self.relation_matrices}) != 1:
+                raise ValueError('All relation matrices of sweep must have the same number of variants.')
+            if dt <= 0 or steps < 1:
+                raise ValueError(f'Sweep needs positive timestep and step count however {dt} and {steps} were given.')
+            self.dt = dt
+            self.steps = steps
+            self.model_options = model_options if model_options is not None else {}
+            self.workers = workers if workers is not None else os.cpu_count()
+            self.linking_distance = linking_distance
+            self.min_cluster_size = min_cluster_size
+            self.final_states = None
+        except Exception as e:
+            exception_type = type(e)
+            raise exception_type(f'During initialization of parameter sweep exception occured {type(e).__name__} -> {e}')
+
+    def run(self):
+        initial = ParticleModel(ParticleModelConfiguration(variaton_relations=self.relation_matrices[0], **self.model_options))
+        states_shape = (len(self.relation_matrices),) + initial.state.shape
+        shared_states = shared_memory.SharedMemory(create=True, size=int(np.prod(states_shape)) * 8)
+        try:
+            states = np.ndarray(states_shape, dtype=np.float64, buffer=shared_states.buf)
+            states[...] = initial.state
+            with ProcessPoolExecutor(max_workers=self.workers, initializer=init_sweep_worker,
+                                     initargs=(shared_states.name, states_shape, initial.variants, self.model_options,
+                                               self.dt, self.steps, self.linking_distance, self.min_cluster_size)
+                                     ) as executor:
+                results = list(executor.map(run_sweep_member, enumerate(self.relation_matrices),
+                                            chunksize=max(1, len(self.relation_matrices) // (4 * self.workers))))
+            self.final_states = states.copy()
+        finally:
+            shared_states.close()
+            shared_states.unlink()
+        for result in results:
+            result['variaton_relations'] = json.dumps(self.relation_matrices[result['run']].tolist())
+        return results
+
+    @staticmethod
+    def write_table(path, results):
+        with open(path, 'w', newline='') as table_file:
+            writer = csv.DictWriter(table_file, fieldnames=list(results[0].keys()))
+            writer.writeheader()
+            writer.writerows(results)
 
 
 #===================================================================================================
@@ -162,9 +835,19 @@ class UserInterface:
             self.timer = pg.time.Clock()
             self.cfg = cfg
             self.running = False
+            self.prepare_particle_sprite()
         except Exception as e:
             exception_type = type(e)
             raise exception_type(f'During initialization of user interface exception occured {type(e).__name__} -> {e}')
+
+    def prepare_particle_sprite(self):
+        # Particle is drawn as set of pixel offsets forming a disk, colors are mapped to screen format once
+        radius = self.cfg.particle_radius
+        offsets_y, offsets_x = np.mgrid[-radius:radius+1, -radius:radius+1]
+        disk = offsets_x*offsets_x + offsets_y*offsets_y <= radius*radius
+        self.sprite_offsets_x = offsets_x[disk]
+        self.sprite_offsets_y = offsets_y[disk]
+        self.particle_colors = np.array([self.screen.map_rgb(color) for color in PARTICLE_COLORS])
         
     def loop(self):
         self.running = True
@@ -185,24 +868,147 @@ class UserInterface:
                self.running = False 
 
     def draw_particles(self):
-        for i in range(self.model.cfg.particle_count):
-            particle_position = np.array(self.model.state[0:2,i], dtype=np.int64).tolist()
-            pg.draw.circle(self.screen,
-                           PARTICLE_COLORS[self.model.variants[i]],
-                           particle_position,
-                           self.cfg.particle_radius) 
+        # All disks are splatted into screen pixels at once, they wrap around edges like particles do
+        width, height = self.screen.get_size()
+        positions = self.model.state[0:2,:].astype(np.int64)
+        pixels_x = np.remainder(positions[0,:,np.newaxis] + self.sprite_offsets_x, width)
+        pixels_y = np.remainder(positions[1,:,np.newaxis] + self.sprite_offsets_y, height)
+        pixels = pg.surfarray.pixels2d(self.screen)
+        pixels[pixels_x, pixels_y] = self.particle_colors[self.model.variants][:,np.newaxis]
+        del pixels
+
+class ReplayInterface(UserInterface):
+
+    SCRUB_FRAMES = 10
+
+    def handle_events(self):
+        for event in pg.event.get():
+            if event.type == pg.QUIT:
+               self.running = False 
+            elif event.type == pg.KEYDOWN:
+                if event.key == pg.K_SPACE:
+                    self.model.paused = not self.model.paused
+                elif event.key == pg.K_RIGHT:
+                    self.model.scrub(self.SCRUB_FRAMES)
+                elif event.key == pg.K_LEFT:
+                    self.model.scrub(-self.SCRUB_FRAMES)
+                elif event.key == pg.K_HOME:
+                    self.model.show_frame(0)
+                elif event.key == pg.K_END:
+                    self.model.show_frame(len(self.model.trajectory) - 1)
 
 #===================================================================================================
 #                                         MAIN FUNCTION 
 #===================================================================================================
 
-def main():
-    model_cfg = ParticleModelConfiguration(particle_count=100)
-    model = ParticleModel(model_cfg)
+def size2D(txt):
+    return tuple(map(int,txt.split('x')))
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--particle_count', type=int, default=100,
+                        help='Number of simulated particles')
+    parser.add_argument('--simulation_size', type=size2D, default=ParticleModelConfiguration.DEFAULT_SIMULATION_SIZE,
+                        help='Size of simulated area written as WIDTHxHEIGHT')
+    parser.add_argument('--force_engine', choices=ParticleModelConfiguration.FORCE_ENGINES,
+                        default=ParticleModelConfiguration.FORCE_ENGINES[0],
+                        help='Exact dense forces, Barnes-Hut approximation or exact forces in memory bounded chunks. '
+                             'Barnes-Hut takes about 2.5 s and 300 MB per step at 100k particles, so it suits headless '
+                             'runs of large systems rather than interactive window')
+    parser.add_argument('--opening_angle', type=float, default=ParticleModelConfiguration.DEFAULT_OPENING_ANGLE,
+                        help='Barnes-Hut opening angle, smaller is more accurate and slower')
+    parser.add_argument('--max_force_memory', type=int, default=ParticleModelConfiguration.DEFAULT_MAX_FORCE_MEMORY // 2**20,
+                        help='Memory in MB available to chunked engine for force computation')
+    parser.add_argument('--single_precision', action='store_true',
+                        help='Chunked engine computes forces in float32')
+    parser.add_argument('--integrator', choices=ParticleModelConfiguration.INTEGRATORS,
+                        default=ParticleModelConfiguration.INTEGRATORS[0],
+                        help='Method used to advance positions and velocities')
+    parser.add_argument('--max_displacement', type=float, default=None,
+                        help='Splits frame into substeps so that particles move at most this far per substep')
+    parser.add_argument('--collisions', action='store_true',
+                        help='Particles bounce off each other as hard disks of drawn radius')
+    parser.add_argument('--headless', action='store_true',
+                        help='Runs simulation without window using fixed timestep')
+    parser.add_argument('--dt', type=float, default=0.1,
+                        help='Fixed timestep used in headless mode')
+    parser.add_argument('--steps', type=int, default=1000,
+                        help='Number of steps performed in headless mode')
+    parser.add_argument('--record_dir', type=str, default=None,
+                        help='Directory to which trajectory of headless run is written')
+    parser.add_argument('--record_every', type=int, default=1,
+                        help='Records every given number of steps')
+    parser.add_argument('--sweep', type=str, default=None,
+                        help='JSON file with list of relation matrices simulated headless on process pool')
+    parser.add_argument('--sweep_random', type=int, default=None,
+                        help='Number of random relation matrices simulated headless on process pool')
+    parser.add_argument('--variant_count', type=int, default=DEFAULT_VARIANT_RELATIONS.shape[0],
+                        help='Number of variants in random relation matrices')
+    parser.add_argument('--sweep_output', type=str, default='sweep_results.csv',
+                        help='CSV file to which sweep metrics are written')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of sweep processes, by default all cores are used')
+    parser.add_argument('--linking_distance', type=float, default=ParameterSweep.DEFAULT_LINKING_DISTANCE,
+                        help='Particles closer than this are counted into one cluster')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Seed of random number generator')
+    parser.add_argument('--replay', type=str, default=None,
+                        help='Directory with recorded trajectory that is played back instead of simulating')
+    parser.add_argument('--playback_speed', type=float, default=1.0,
+                        help='Multiplier of playback speed during replay')
+    return parser.parse_args()
+
+def run_headless(model, args):
+    recorder = None
+    if args.record_dir is not None:
+        recorder = TrajectoryRecorder(args.record_dir, model, args.dt, args.record_every)
+    try:
+        summary = HeadlessSimulation(model, args.dt, args.steps, recorder).run()
+    finally:
+        if recorder is not None:
+            recorder.close()
+    print(f'{summary["steps"]} steps in {summary["elapsed"]:.2f}s -> {summary["steps_per_second"]:.1f} steps/s')
+
+def run_sweep(model_options, args):
+    if args.sweep is not None:
+        with open(args.sweep) as sweep_file:
+            relation_matrices = json.load(sweep_file)
+    else:
+        relation_matrices = np.random.uniform(-0.1, 0.1, (args.sweep_random, args.variant_count, args.variant_count))
+    sweep = ParameterSweep(relation_matrices, args.dt, args.steps, model_options, args.workers, args.linking_distance)
+    start = time.perf_counter()
+    results = sweep.run()
+    ParameterSweep.write_table(args.sweep_output, results)
+    print(f'{len(results)} runs in {time.perf_counter() - start:.2f}s written to {args.sweep_output}')
+
+def main(args):
     cfg = UserInterfaceConfig(particle_radius=3, time_scaling=0.01)
+    if args.replay is not None:
+        ui = ReplayInterface(cfg=cfg, model=ReplayModel(Trajectory(args.replay), args.playback_speed))
+        ui.loop()
+        return
+    np.random.seed(args.seed)
+    model_options = {'simulation_size': args.simulation_size,
+                     'particle_count': args.particle_count,
+                     'force_engine': args.force_engine,
+                     'opening_angle': args.opening_angle,
+                     'max_force_memory': args.max_force_memory * 2**20,
+                     'single_precision': args.single_precision,
+                     'integrator': args.integrator,
+                     'max_displacement': args.max_displacement,
+                     'collision_radius': cfg.particle_radius if args.collisions else None}
+    if args.sweep is not None or args.sweep_random is not None:
+        run_sweep(model_options, args)
+        return
+    model_cfg = ParticleModelConfiguration(**model_options)
+    model = ParticleModel(model_cfg)
+    if args.headless:
+        run_headless(model, args)
+        return
     ui = UserInterface(cfg=cfg, model=model)
     ui.loop()
 
 if __name__ == '__main__':
-    main()
+    args = parse_arguments()
+    main(args)
     
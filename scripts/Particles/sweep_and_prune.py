@@ -0,0 +1,136 @@
+import numpy as np
+
+
+def expand_ranges(starts, ends):
+    # Concatenation of arange(start, end) for all pairs without python loop
+    lengths = ends - starts
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return offsets + np.arange(lengths.sum())
+
+
+class SweepAndPrune:
+    '''
+    Elastic collisions of equally heavy hard disks. Simulation is cut into horizontal bands at
+    least one diameter high and particles are swept along x axis within their band and against
+    the band above. Sorting key is band and x coordinate, its order is kept between calls, so
+    sorting almost sorted keys again is close to linear. Particles near side borders are repeated
+    behind the opposite border to find pairs touching across the wrap.
+    '''
+
+    MAX_PASSES = 16
+    # Relative kinetic energy gain above this means contacts were not resolved elastically
+    ENERGY_TOLERANCE = 1e-9
+
+    def __init__(self, radius, simulation_size):
+        self.diameter = 2*radius
+        self.simulation_size = np.array(simulation_size, dtype=np.float64)
+        self.band_count = max(int(self.simulation_size[1] // self.diameter), 1)
+        # Bands are spaced so that keys of repeated particles never reach neighbouring band
+        self.band_stride = self.simulation_size[0] + 3*self.diameter
+        self.order = np.zeros(0, dtype=np.int64)
+        self.random = np.random.default_rng(0)
+
+    def candidate_pairs(self, positions):
+        # Positions are rows (x, y), returns both particles of every candidate pair and their
+        # distance along x
+        particle_count = len(positions)
+        width, height = self.simulation_size
+        bands = np.minimum((positions[:,1] * (self.band_count / height)).astype(np.int64), self.band_count - 1)
+        keys = bands*self.band_stride + self.diameter + positions[:,0]
+        if len(self.order) != particle_count:
+            self.order = np.arange(particle_count)
+        keys = keys[self.order]
+        resorted = np.argsort(keys, kind='stable')
+        self.order = self.order[resorted]
+        keys = keys[resorted]
+        bands = bands[self.order]
+
+        coordinates = positions[self.order, 0]
+        right_ghosts = np.flatnonzero(coordinates < self.diameter)
+        left_ghosts = np.flatnonzero(coordinates > width - self.diameter)
+        extended_keys = np.concatenate([keys, keys[right_ghosts] + width, keys[left_ghosts] - width])
+        extended_slots = np.concatenate([np.arange(particle_count), right_ghosts, left_ghosts])
+        merged = np.argsort(extended_keys, kind='stable')
+        extended_keys = extended_keys[merged]
+        extended_order = self.order[extended_slots[merged]]
+        own_slots = np.empty(particle_count, dtype=np.int64)
+        originals = merged < particle_count
+        own_slots[merged[originals]] = np.flatnonzero(originals)
+
+        # Own band is swept forward only, band above in whole window around particle
+        offsets = np.where(bands < self.band_count - 1, self.band_stride, -(self.band_count - 1)*self.band_stride)
+        windows = [(own_slots + 1,
+                    np.searchsorted(extended_keys, keys + self.diameter, side='right'),
+                    np.zeros(particle_count))]
+        if self.band_count > 1:
+            starts = np.searchsorted(extended_keys, keys + offsets - self.diameter, side='left')
+            ends = np.searchsorted(extended_keys, keys + offsets + self.diameter, side='right')
+            if self.band_count == 2:
+                # With two bands the band above the upper one is the lower one, visited already
+                ends[bands == 1] = starts[bands == 1]
+            windows.append((starts, ends, offsets))
+
+        firsts, seconds, delta_x = [], [], []
+        for starts, ends, key_offsets in windows:
+            lengths = ends - starts
+            slots = expand_ranges(starts, ends)
+            firsts.append(np.repeat(self.order, lengths))
+            seconds.append(extended_order[slots])
+            delta_x.append(extended_keys[slots] - np.repeat(keys + key_offsets, lengths))
+        return np.concatenate(firsts), np.concatenate(seconds), np.concatenate(delta_x)
+
+    def independent_contacts(self, firsts, seconds, particle_count):
+        # Contacts with random priority lower than every other contact of both their particles,
+        # no particle appears twice among them
+        priorities = self.random.permutation(len(firsts))
+        lowest = np.full(particle_count, len(firsts))
+        np.minimum.at(lowest, firsts, priorities)
+        np.minimum.at(lowest, seconds, priorities)
+        return np.flatnonzero((lowest[firsts] == priorities) & (lowest[seconds] == priorities))
+
+    def resolve(self, positions, velocities):
+        # Positions and velocities are rows (x, y) changed in place, returns number of contacts
+        firsts, seconds, delta_x = self.candidate_pairs(positions)
+        delta_y = positions[seconds,1] - positions[firsts,1]
+        delta_y -= self.simulation_size[1] * np.round(delta_y / self.simulation_size[1])
+        distance2 = delta_x*delta_x + delta_y*delta_y
+        touching = (distance2 < self.diameter*self.diameter) & (distance2 > 0)
+        if not np.any(touching):
+            return 0
+        firsts = firsts[touching]
+        seconds = seconds[touching]
+        distance = np.sqrt(distance2[touching])
+        normals = np.stack([delta_x[touching], delta_y[touching]], axis=1) / distance[:,np.newaxis]
+        particle_count = len(positions)
+
+        # Overlaps are removed by pushing both particles apart by half of it, averaged over all
+        # contacts of the particle so crowded particles are not pushed too far
+        corrections = normals * (0.5*(self.diameter - distance))[:,np.newaxis]
+        contact_counts = np.maximum(np.bincount(firsts, minlength=particle_count) +
+                                    np.bincount(seconds, minlength=particle_count), 1)
+        for axis in range(2):
+            shift = (np.bincount(seconds, weights=corrections[:,axis], minlength=particle_count) -
+                     np.bincount(firsts, weights=corrections[:,axis], minlength=particle_count))
+            positions[:,axis] += shift / contact_counts
+        np.remainder(positions, self.simulation_size, out=positions)
+
+        # Approaching pairs swap velocity components along line connecting centers. Pair swap
+        # keeps energy only when particle takes part in one swap at a time, so contacts are
+        # resolved in passes over sets of independent contacts, velocities updated between them
+        energy_before = np.einsum('ij,ij->', velocities, velocities)
+        pending = np.arange(len(firsts))
+        for _ in range(self.MAX_PASSES):
+            closing = np.einsum('ij,ij->i', velocities[seconds[pending]] - velocities[firsts[pending]], normals[pending])
+            approaching = closing < 0
+            pending = pending[approaching]
+            if len(pending) == 0:
+                break
+            chosen = self.independent_contacts(firsts[pending], seconds[pending], particle_count)
+            contacts = pending[chosen]
+            impulses = normals[contacts] * closing[approaching][chosen][:,np.newaxis]
+            velocities[firsts[contacts]] += impulses
+            velocities[seconds[contacts]] -= impulses
+        energy_after = np.einsum('ij,ij->', velocities, velocities)
+        if energy_after > energy_before * (1 + self.ENERGY_TOLERANCE) + self.ENERGY_TOLERANCE:
+            raise RuntimeError(f'Collisions changed kinetic energy from {energy_before} to {energy_after}.')
+        return len(firsts)